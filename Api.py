@@ -2,7 +2,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import requests
 import random
 import json
 import hashlib
@@ -10,10 +9,14 @@ import hmac
 import urllib.parse
 import uuid
 import time
-import copy
+from types import MappingProxyType
 from datetime import datetime
 import os
 from dVideo import dVideo
+import Connections
+import Retry
+import DebugCapture
+from Paginator import Paginator
 from requests_toolbelt import MultipartEncoder
 import logging
 
@@ -28,6 +31,15 @@ try:
 except:
     print("Fail to import moviepy. Need only for Video upload.")
 
+# parses the raw response bytes, orjson is used when it is installed (optional, pip install orjson)
+# without it the bytes are decoded first, json.loads of bytes is slower than of text on large inbox payloads
+try:
+    import orjson
+    parse_json = orjson.loads
+except ImportError:
+    def parse_json(content):
+        return json.loads(content.decode("utf-8"))
+
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 logging.getLogger("requests").setLevel(logging.WARNING)
@@ -45,6 +57,18 @@ class InstagramAPI:
     EXPERIMENTS = 'ig_promote_reach_objective_fix_universe,ig_android_universe_video_production,ig_search_client_h1_2017_holdout,ig_android_live_follow_from_comments_universe,ig_android_carousel_non_square_creation,ig_android_live_analytics,ig_android_follow_all_dialog_confirmation_copy,ig_android_stories_server_coverframe,ig_android_video_captions_universe,ig_android_offline_location_feed,ig_android_direct_inbox_retry_seen_state,ig_android_ontact_invite_universe,ig_android_live_broadcast_blacklist,ig_android_insta_video_reconnect_viewers,ig_android_ad_async_ads_universe,ig_android_search_clear_layout_universe,ig_android_shopping_reporting,ig_android_stories_surface_universe,ig_android_verified_comments_universe,ig_android_preload_media_ahead_in_current_reel,android_instagram_prefetch_suggestions_universe,ig_android_reel_viewer_fetch_missing_reels_universe,ig_android_direct_search_share_sheet_universe,ig_android_business_promote_tooltip,ig_android_direct_blue_tab,ig_android_async_network_tweak_universe,ig_android_elevate_main_thread_priority_universe,ig_android_stories_gallery_nux,ig_android_instavideo_remove_nux_comments,ig_video_copyright_whitelist,ig_react_native_inline_insights_with_relay,ig_android_direct_thread_message_animation,ig_android_draw_rainbow_client_universe,ig_android_direct_link_style,ig_android_live_heart_enhancements_universe,ig_android_rtc_reshare,ig_android_preload_item_count_in_reel_viewer_buffer,ig_android_users_bootstrap_service,ig_android_auto_retry_post_mode,ig_android_shopping,ig_android_main_feed_seen_state_dont_send_info_on_tail_load,ig_fbns_preload_default,ig_android_gesture_dismiss_reel_viewer,ig_android_tool_tip,ig_android_ad_logger_funnel_logging_universe,ig_android_gallery_grid_column_count_universe,ig_android_business_new_ads_payment_universe,ig_android_direct_links,ig_android_audience_control,ig_android_live_encore_consumption_settings_universe,ig_perf_android_holdout,ig_android_cache_contact_import_list,ig_android_links_receivers,ig_android_ad_impression_backtest,ig_android_list_redesign,ig_android_stories_separate_overlay_creation,ig_android_stop_video_recording_fix_universe,ig_android_render_video_segmentation,ig_android_live_encore_reel_chaining_universe,ig_android_sync_on_background_enhanced_10_25,ig_android_immersive_viewer,ig_android_mqtt_skywalker,ig_fbns_push,ig_android_ad_watchmore_overlay_universe,ig_android_react_native_universe,ig_android_profile_tabs_redesign_universe,ig_android_live_consumption_abr,ig_android_story_viewer_social_context,ig_android_hide_post_in_feed,ig_android_video_loopcount_int,ig_android_enable_main_feed_reel_tray_preloading,ig_android_camera_upsell_dialog,ig_android_ad_watchbrowse_universe,ig_android_internal_research_settings,ig_android_search_people_tag_universe,ig_android_react_native_ota,ig_android_enable_concurrent_request,ig_android_react_native_stories_grid_view,ig_android_business_stories_inline_insights,ig_android_log_mediacodec_info,ig_android_direct_expiring_media_loading_errors,ig_video_use_sve_universe,ig_android_cold_start_feed_request,ig_android_enable_zero_rating,ig_android_reverse_audio,ig_android_branded_content_three_line_ui_universe,ig_android_live_encore_production_universe,ig_stories_music_sticker,ig_android_stories_teach_gallery_location,ig_android_http_stack_experiment_2017,ig_android_stories_device_tilt,ig_android_pending_request_search_bar,ig_android_fb_topsearch_sgp_fork_request,ig_android_seen_state_with_view_info,ig_android_animation_perf_reporter_timeout,ig_android_new_block_flow,ig_android_story_tray_title_play_all_v2,ig_android_direct_address_links,ig_android_stories_archive_universe,ig_android_save_collections_cover_photo,ig_android_live_webrtc_livewith_production,ig_android_sign_video_url,ig_android_stories_video_prefetch_kb,ig_android_stories_create_flow_favorites_tooltip,ig_android_live_stop_broadcast_on_404,ig_android_live_viewer_invite_universe,ig_android_promotion_feedback_channel,ig_android_render_iframe_interval,ig_android_accessibility_logging_universe,ig_android_camera_shortcut_universe,ig_android_use_one_cookie_store_per_user_override,ig_profile_holdout_2017_universe,ig_android_stories_server_brushes,ig_android_ad_media_url_logging_universe,ig_android_shopping_tag_nux_text_universe,ig_android_comments_single_reply_universe,ig_android_stories_video_loading_spinner_improvements,ig_android_collections_cache,ig_android_comment_api_spam_universe,ig_android_facebook_twitter_profile_photos,ig_android_shopping_tag_creation_universe,ig_story_camera_reverse_video_experiment,ig_android_direct_bump_selected_recipients,ig_android_ad_cta_haptic_feedback_universe,ig_android_vertical_share_sheet_experiment,ig_android_family_bridge_share,ig_android_search,ig_android_insta_video_consumption_titles,ig_android_stories_gallery_preview_button,ig_android_fb_auth_education,ig_android_camera_universe,ig_android_me_only_universe,ig_android_instavideo_audio_only_mode,ig_android_user_profile_chaining_icon,ig_android_live_video_reactions_consumption_universe,ig_android_stories_hashtag_text,ig_android_post_live_badge_universe,ig_android_swipe_fragment_container,ig_android_search_users_universe,ig_android_live_save_to_camera_roll_universe,ig_creation_growth_holdout,ig_android_sticker_region_tracking,ig_android_unified_inbox,ig_android_live_new_watch_time,ig_android_offline_main_feed_10_11,ig_import_biz_contact_to_page,ig_android_live_encore_consumption_universe,ig_android_experimental_filters,ig_android_search_client_matching_2,ig_android_react_native_inline_insights_v2,ig_android_business_conversion_value_prop_v2,ig_android_redirect_to_low_latency_universe,ig_android_ad_show_new_awr_universe,ig_family_bridges_holdout_universe,ig_android_background_explore_fetch,ig_android_following_follower_social_context,ig_android_video_keep_screen_on,ig_android_ad_leadgen_relay_modern,ig_android_profile_photo_as_media,ig_android_insta_video_consumption_infra,ig_android_ad_watchlead_universe,ig_android_direct_prefetch_direct_story_json,ig_android_shopping_react_native,ig_android_top_live_profile_pics_universe,ig_android_direct_phone_number_links,ig_android_stories_weblink_creation,ig_android_direct_search_new_thread_universe,ig_android_histogram_reporter,ig_android_direct_on_profile_universe,ig_android_network_cancellation,ig_android_background_reel_fetch,ig_android_react_native_insights,ig_android_insta_video_audio_encoder,ig_android_family_bridge_bookmarks,ig_android_data_usage_network_layer,ig_android_universal_instagram_deep_links,ig_android_dash_for_vod_universe,ig_android_modular_tab_discover_people_redesign,ig_android_mas_sticker_upsell_dialog_universe,ig_android_ad_add_per_event_counter_to_logging_event,ig_android_sticky_header_top_chrome_optimization,ig_android_rtl,ig_android_biz_conversion_page_pre_select,ig_android_promote_from_profile_button,ig_android_live_broadcaster_invite_universe,ig_android_share_spinner,ig_android_text_action,ig_android_own_reel_title_universe,ig_promotions_unit_in_insights_landing_page,ig_android_business_settings_header_univ,ig_android_save_longpress_tooltip,ig_android_constrain_image_size_universe,ig_android_business_new_graphql_endpoint_universe,ig_ranking_following,ig_android_stories_profile_camera_entry_point,ig_android_universe_reel_video_production,ig_android_power_metrics,ig_android_sfplt,ig_android_offline_hashtag_feed,ig_android_live_skin_smooth,ig_android_direct_inbox_search,ig_android_stories_posting_offline_ui,ig_android_sidecar_video_upload_universe,ig_android_promotion_manager_entry_point_universe,ig_android_direct_reply_audience_upgrade,ig_android_swipe_navigation_x_angle_universe,ig_android_offline_mode_holdout,ig_android_live_send_user_location,ig_android_direct_fetch_before_push_notif,ig_android_non_square_first,ig_android_insta_video_drawing,ig_android_swipeablefilters_universe,ig_android_live_notification_control_universe,ig_android_analytics_logger_running_background_universe,ig_android_save_all,ig_android_reel_viewer_data_buffer_size,ig_direct_quality_holdout_universe,ig_android_family_bridge_discover,ig_android_react_native_restart_after_error_universe,ig_android_startup_manager,ig_story_tray_peek_content_universe,ig_android_profile,ig_android_high_res_upload_2,ig_android_http_service_same_thread,ig_android_scroll_to_dismiss_keyboard,ig_android_remove_followers_universe,ig_android_skip_video_render,ig_android_story_timestamps,ig_android_live_viewer_comment_prompt_universe,ig_profile_holdout_universe,ig_android_react_native_insights_grid_view,ig_stories_selfie_sticker,ig_android_stories_reply_composer_redesign,ig_android_streamline_page_creation,ig_explore_netego,ig_android_ig4b_connect_fb_button_universe,ig_android_feed_util_rect_optimization,ig_android_rendering_controls,ig_android_os_version_blocking,ig_android_encoder_width_safe_multiple_16,ig_search_new_bootstrap_holdout_universe,ig_android_snippets_profile_nux,ig_android_e2e_optimization_universe,ig_android_comments_logging_universe,ig_shopping_insights,ig_android_save_collections,ig_android_live_see_fewer_videos_like_this_universe,ig_android_show_new_contact_import_dialog,ig_android_live_view_profile_from_comments_universe,ig_fbns_blocked,ig_formats_and_feedbacks_holdout_universe,ig_android_reduce_view_pager_buffer,ig_android_instavideo_periodic_notif,ig_search_user_auto_complete_cache_sync_ttl,ig_android_marauder_update_frequency,ig_android_suggest_password_reset_on_oneclick_login,ig_android_promotion_entry_from_ads_manager_universe,ig_android_live_special_codec_size_list,ig_android_enable_share_to_messenger,ig_android_background_main_feed_fetch,ig_android_live_video_reactions_creation_universe,ig_android_channels_home,ig_android_sidecar_gallery_universe,ig_android_upload_reliability_universe,ig_migrate_mediav2_universe,ig_android_insta_video_broadcaster_infra_perf,ig_android_business_conversion_social_context,android_ig_fbns_kill_switch,ig_android_live_webrtc_livewith_consumption,ig_android_destroy_swipe_fragment,ig_android_react_native_universe_kill_switch,ig_android_stories_book_universe,ig_android_all_videoplayback_persisting_sound,ig_android_draw_eraser_universe,ig_direct_search_new_bootstrap_holdout_universe,ig_android_cache_layer_bytes_threshold,ig_android_search_hash_tag_and_username_universe,ig_android_business_promotion,ig_android_direct_search_recipients_controller_universe,ig_android_ad_show_full_name_universe,ig_android_anrwatchdog,ig_android_qp_kill_switch,ig_android_2fac,ig_direct_bypass_group_size_limit_universe,ig_android_promote_simplified_flow,ig_android_share_to_whatsapp,ig_android_hide_bottom_nav_bar_on_discover_people,ig_fbns_dump_ids,ig_android_hands_free_before_reverse,ig_android_skywalker_live_event_start_end,ig_android_live_join_comment_ui_change,ig_android_direct_search_story_recipients_universe,ig_android_direct_full_size_gallery_upload,ig_android_ad_browser_gesture_control,ig_channel_server_experiments,ig_android_video_cover_frame_from_original_as_fallback,ig_android_ad_watchinstall_universe,ig_android_ad_viewability_logging_universe,ig_android_new_optic,ig_android_direct_visual_replies,ig_android_stories_search_reel_mentions_universe,ig_android_threaded_comments_universe,ig_android_mark_reel_seen_on_Swipe_forward,ig_internal_ui_for_lazy_loaded_modules_experiment,ig_fbns_shared,ig_android_capture_slowmo_mode,ig_android_live_viewers_list_search_bar,ig_android_video_single_surface,ig_android_offline_reel_feed,ig_android_video_download_logging,ig_android_last_edits,ig_android_exoplayer_4142,ig_android_post_live_viewer_count_privacy_universe,ig_android_activity_feed_click_state,ig_android_snippets_haptic_feedback,ig_android_gl_drawing_marks_after_undo_backing,ig_android_mark_seen_state_on_viewed_impression,ig_android_live_backgrounded_reminder_universe,ig_android_live_hide_viewer_nux_universe,ig_android_live_monotonic_pts,ig_android_search_top_search_surface_universe,ig_android_user_detail_endpoint,ig_android_location_media_count_exp_ig,ig_android_comment_tweaks_universe,ig_android_ad_watchmore_entry_point_universe,ig_android_top_live_notification_universe,ig_android_add_to_last_post,ig_save_insights,ig_android_live_enhanced_end_screen_universe,ig_android_ad_add_counter_to_logging_event,ig_android_blue_token_conversion_universe,ig_android_exoplayer_settings,ig_android_progressive_jpeg,ig_android_offline_story_stickers,ig_android_gqls_typing_indicator,ig_android_chaining_button_tooltip,ig_android_video_prefetch_for_connectivity_type,ig_android_use_exo_cache_for_progressive,ig_android_samsung_app_badging,ig_android_ad_holdout_watchandmore_universe,ig_android_offline_commenting,ig_direct_stories_recipient_picker_button,ig_insights_feedback_channel_universe,ig_android_insta_video_abr_resize,ig_android_insta_video_sound_always_on'''
     SIG_KEY_VERSION = '4'
 
+    # header profiles, never mutated, every request passes its own set (base profile + per-request values)
+    # so one session can run several requests at once without headers leaking between them
+    BASE_HEADERS = MappingProxyType({'Accept': '*/*',
+                                     'Accept-Language': 'en-US',
+                                     'Accept-Encoding': 'gzip, deflate',
+                                     'Cookie2': '$Version=1',
+                                     'X-IG-Capabilities': '3Q4=',
+                                     'X-IG-Connection-Type': 'WIFI',
+                                     'X-IG-App-ID': '567067343352427',
+                                     'User-Agent': USER_AGENT})
+    FORM_HEADERS = MappingProxyType(dict(BASE_HEADERS, **{'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8'}))
+
     # username            # Instagram username
     # password            # Instagram password
     # debug               # Debug
@@ -63,8 +87,8 @@ class InstagramAPI:
         self.uuid = self.generateUUID(True)
         self.username = username
         self.isLoggedIn = False
-        self.LastResponse = None
-        self.s = requests.Session()
+        # keep-alive pools per host, see Connections
+        self.s = Connections.create_session()
 
     def sendMessage(self, target_user, msgText):
         target_user = '[[{}]]'.format(','.join([target_user]))
@@ -97,18 +121,19 @@ class InstagramAPI:
             if (self.SendRequest('si/fetch_headers/?challenge_type=signup&guid=' + self.generateUUID(False), None, True)):
 
                 data = {'phone_id': self.generateUUID(True),
-                        '_csrftoken': self.LastResponse.cookies['csrftoken'],
+                        '_csrftoken': self.s.cookies.get('csrftoken'),
                         'username': self.username,
                         'guid': self.uuid,
                         'device_id': self.device_id,
                         'password': password,
                         'login_attempt_count': '0'}
 
-                if (self.SendRequest('accounts/login/', self.generateSignature(json.dumps(data)), True)):
+                logged_in = self.SendRequest('accounts/login/', self.generateSignature(json.dumps(data)), True)
+                if (logged_in):
                     self.isLoggedIn = True
-                    self.username_id = self.LastJson["logged_in_user"]["pk"]
+                    self.username_id = logged_in["logged_in_user"]["pk"]
                     self.rank_token = "%s_%s" % (self.username_id, self.uuid)
-                    self.token = self.LastResponse.cookies["csrftoken"]
+                    self.token = self.s.cookies.get("csrftoken")
                     self.syncFeatures()
                     self.autoCompleteUserList()
                     self.timelineFeed()
@@ -156,15 +181,8 @@ class InstagramAPI:
         if is_sidecar:
             data['is_sidecar'] = '1'
         m = MultipartEncoder(data, boundary=self.uuid)
-        self.s.headers.update({'X-IG-Capabilities': '3Q4=',
-                               'X-IG-Connection-Type': 'WIFI',
-                               'Cookie2': '$Version=1',
-                               'Accept-Language': 'en-US',
-                               'Accept-Encoding': 'gzip, deflate',
-                               'Content-type': m.content_type,
-                               'Connection': 'close',
-                               'User-Agent': self.USER_AGENT})
-        response = self.s.post(self.API_URL + "upload/photo/", data=m.to_string())
+        headers = self.compose_headers({'Content-type': m.content_type})
+        response = self.s.post(self.API_URL + "upload/photo/", data=m.to_string(), headers=headers)
         if response.status_code == 200:
             if self.configure(upload_id, photo, caption):
                 self.expose()
@@ -180,18 +198,10 @@ class InstagramAPI:
         if is_sidecar:
             data['is_sidecar'] = '1'
         m = MultipartEncoder(data, boundary=self.uuid)
-        self.s.headers.update({'X-IG-Capabilities': '3Q4=',
-                               'X-IG-Connection-Type': 'WIFI',
-                               'Host': 'i.instagram.com',
-                               'Cookie2': '$Version=1',
-                               'Accept-Language': 'en-US',
-                               'Accept-Encoding': 'gzip, deflate',
-                               'Content-type': m.content_type,
-                               'Connection': 'keep-alive',
-                               'User-Agent': self.USER_AGENT})
-        response = self.s.post(self.API_URL + "upload/video/", data=m.to_string())
+        headers = self.compose_headers({'Content-type': m.content_type})
+        response = self.s.post(self.API_URL + "upload/video/", data=m.to_string(), headers=headers)
         if response.status_code == 200:
-            body = json.loads(response.text)
+            body = parse_json(response.content)
             upload_url = body['video_upload_urls'][3]['url']
             upload_job = body['video_upload_urls'][3]['job']
 
@@ -200,19 +210,10 @@ class InstagramAPI:
             request_size = len(videoData) // 4
             lastRequestExtra = (len(videoData) - (request_size * 3))
 
-            headers = copy.deepcopy(self.s.headers)
-            self.s.headers.update({'X-IG-Capabilities': '3Q4=',
-                                   'X-IG-Connection-Type': 'WIFI',
-                                   'Cookie2': '$Version=1',
-                                   'Accept-Language': 'en-US',
-                                   'Accept-Encoding': 'gzip, deflate',
-                                   'Content-type': 'application/octet-stream',
-                                   'Session-ID': upload_id,
-                                   'Connection': 'keep-alive',
-                                   'Content-Disposition': 'attachment; filename="video.mov"',
-                                   'job': upload_job,
-                                   'Host': 'upload.instagram.com',
-                                   'User-Agent': self.USER_AGENT})
+            chunk_headers = {'Content-type': 'application/octet-stream',
+                             'Session-ID': upload_id,
+                             'Content-Disposition': 'attachment; filename="video.mov"',
+                             'job': upload_job}
             for i in range(0, 4):
                 start = i * request_size
                 if i == 3:
@@ -223,9 +224,8 @@ class InstagramAPI:
                 content_range = "bytes {start}-{end}/{lenVideo}".format(start=start, end=(end - 1),
                                                                         lenVideo=len(videoData)).encode('utf-8')
 
-                self.s.headers.update({'Content-Length': str(end - start), 'Content-Range': content_range, })
-                response = self.s.post(upload_url, data=videoData[start:start + length])
-            self.s.headers = headers
+                headers = self.compose_headers(chunk_headers, {'Content-Length': str(end - start), 'Content-Range': content_range})
+                response = self.s.post(upload_url, data=videoData[start:start + length], headers=headers)
 
             if response.status_code == 200:
                 if self.configureVideo(upload_id, video, thumbnail, caption):
@@ -371,25 +371,7 @@ class InstagramAPI:
                 'client_sidecar_id': albumUploadId,
                 'caption': captionText,
                 'children_metadata': childrenMetadata}
-        self.SendRequest(endpoint, self.generateSignature(json.dumps(data)))
-        response = self.LastResponse
-        if response.status_code == 200:
-            self.LastResponse = response
-            try:
-                self.LastJson = json.loads(response.text)
-            except:
-                self.LastJson = {}
-            return True
-        else:
-            print("Request return " + str(response.status_code) + " error!")
-            time.sleep(20)
-            # for debugging
-            try:
-                self.LastResponse = response
-                self.LastJson = json.loads(response.text)
-            except:
-                pass
-            return False
+        return self.SendRequest(endpoint, self.generateSignature(json.dumps(data)))
 
     def direct_share(self, media_id, recipients, text=None):
         if not isinstance(recipients, list):
@@ -425,29 +407,11 @@ class InstagramAPI:
             },
         ]
         data = self.buildBody(bodies, boundary)
-        self.s.headers.update({'User-Agent': self.USER_AGENT,
-                               'Proxy-Connection': 'keep-alive',
-                               'Connection': 'keep-alive',
-                               'Accept': '*/*',
-                               'Content-Type': 'multipart/form-data; boundary={}'.format(boundary),
-                               'Accept-Language': 'en-en'})
+        headers = self.compose_headers({'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)})
         # self.SendRequest(endpoint,post=data) #overwrites 'Content-type' header and boundary is missed
-        response = self.s.post(self.API_URL + endpoint, data=data)
+        response = Retry.get_policy(endpoint).run(lambda: self.s.post(self.API_URL + endpoint, data=data, headers=headers))
 
-        if response.status_code == 200:
-            self.LastResponse = response
-            self.LastJson = json.loads(response.text)
-            return True
-        else:
-            print("Request return " + str(response.status_code) + " error!")
-            time.sleep(20)
-            # for debugging
-            try:
-                self.LastResponse = response
-                self.LastJson = json.loads(response.text)
-            except:
-                pass
-            return False
+        return self.get_result(response)
 
     def configureVideo(self, upload_id, video, thumbnail, caption=''):
         clip = VideoFileClip(video)
@@ -608,8 +572,11 @@ class InstagramAPI:
         activity = self.SendRequest('news/?')
         return activity
 
-    def getv2Inbox(self, limit=50):
-        inbox = self.SendRequest('direct_v2/inbox/?persistentBadging=true&use_unified_inbox=true&limit={}'.format(limit))
+    def getv2Inbox(self, limit=50, thread_message_limit=None):
+        endpoint = 'direct_v2/inbox/?persistentBadging=true&use_unified_inbox=true&limit={}'.format(limit)
+        if thread_message_limit is not None:
+            endpoint += '&thread_message_limit={0}'.format(thread_message_limit)
+        inbox = self.SendRequest(endpoint)
         return inbox
 
     def getv2Threads(self, thread, cursor=None):
@@ -826,79 +793,59 @@ class InstagramAPI:
         if (not self.isLoggedIn and not login):
             raise Exception("Not logged in!\n")
 
-        self.s.headers.update({'Connection': 'close',
-                               'Accept': '*/*',
-                               'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-                               'Cookie2': '$Version=1',
-                               'Accept-Language': 'en-US',
-                               'User-Agent': self.USER_AGENT})
+        # network errors and 5xx / 429 are retried with backoff, other errors are returned right away
+        policy = Retry.get_policy(endpoint)
+        if (post is not None):
+            response = policy.run(lambda: self.s.post(self.API_URL + endpoint, data=post, verify=verify, headers=self.FORM_HEADERS))
+        else:
+            response = policy.run(lambda: self.s.get(self.API_URL + endpoint, verify=verify, headers=self.FORM_HEADERS))
 
-        while True:
-            try:
-                if (post is not None):
-                    response = self.s.post(self.API_URL + endpoint, data=post, verify=verify)
-                else:
-                    response = self.s.get(self.API_URL + endpoint, verify=verify)
-                break
-            except Exception as e:
-                print('Except on SendRequest (wait 60 sec and resend): ' + str(e))
-                time.sleep(60)
+        return self.get_result(response)
 
+    def get_result(self, response):
+        # parsed json of a successful response, None otherwise
+        DebugCapture.ring.capture(response.url, response.status_code, response.content)
         if response.status_code == 200:
-            self.LastResponse = response
-            self.LastJson = json.loads(response.text)
-            return True
-        else:
-            print("Request return " + str(response.status_code) + " error!")
-            time.sleep(20)
-            # for debugging
             try:
-                self.LastResponse = response
-                self.LastJson = json.loads(response.text)
-                # print(self.LastJson)
-            except:
-                pass
-            return False
+                return parse_json(response.content)
+            except ValueError:
+                DebugCapture.ring.flush("parse_error")
+                raise
+        print("Request return " + str(response.status_code) + " error!")
+        logging.debug("Error response: {0}".format(response.content[:500]))
+        return None
 
-    def getTotalFollowers(self, usernameId):
-        followers = []
-        next_max_id = ''
-        while 1:
-            self.getUserFollowers(usernameId, next_max_id)
-            temp = self.LastJson
+    # generators over the paged feeds, see Paginator
+    def iterFollowers(self, usernameId, next_max_id='', limit=None):
+        return Paginator(lambda maxid: self.getUserFollowers(usernameId, maxid), "users",
+                         lambda page: page.get("big_list") is not False, next_max_id, limit)
 
-            for item in temp["users"]:
-                followers.append(item)
+    def iterFollowings(self, usernameId, next_max_id='', limit=None):
+        return Paginator(lambda maxid: self.getUserFollowings(usernameId, maxid), "users",
+                         lambda page: page.get("big_list") is not False, next_max_id, limit)
 
-            if temp["big_list"] is False:
-                return followers
-            next_max_id = temp["next_max_id"]
+    def iterUserFeed(self, usernameId, minTimestamp=None, next_max_id='', limit=None):
+        return Paginator(lambda maxid: self.getUserFeed(usernameId, maxid, minTimestamp), "items",
+                         lambda page: page.get("more_available") is not False, next_max_id, limit)
 
-    def getTotalFollowings(self, usernameId):
-        followers = []
-        next_max_id = ''
-        while True:
-            self.getUserFollowings(usernameId, next_max_id)
-            temp = self.LastJson
+    def iterLikedMedia(self, next_max_id='', limit=None, max_pages=None):
+        return Paginator(self.getLikedMedia, "items", lambda page: True, next_max_id, limit, max_pages)
 
-            for item in temp["users"]:
-                followers.append(item)
+    def get_all(self, paginator):
+        # every item of the paginator, a failed request raises instead of returning a partial list
+        items = list(paginator)
+        if paginator.failed:
+            raise Exception("Request failed after {n} items, resume from max_id {m}".format(n = paginator.count, m = paginator.next_max_id))
+        return items
 
-            if temp["big_list"] is False:
-                return followers
-            next_max_id = temp["next_max_id"]
+    def getTotalFollowers(self, usernameId):
+        return self.get_all(self.iterFollowers(usernameId))
+
+    def getTotalFollowings(self, usernameId):
+        return self.get_all(self.iterFollowings(usernameId))
 
     def getTotalUserFeed(self, usernameId, minTimestamp=None):
-        user_feed = []
-        next_max_id = ''
-        while True:
-            self.getUserFeed(usernameId, next_max_id, minTimestamp)
-            temp = self.LastJson
-            for item in temp["items"]:
-                user_feed.append(item)
-            if temp["more_available"] is False:
-                return user_feed
-            next_max_id = temp["next_max_id"]
+        return self.get_all(self.iterUserFeed(usernameId, minTimestamp))
 
     def getTotalSelfUserFeed(self, minTimestamp=None):
         return self.getTotalUserFeed(self.username_id, minTimestamp)
@@ -910,18 +857,7 @@ class InstagramAPI:
         return self.getTotalFollowings(self.username_id)
 
     def getTotalLikedMedia(self, scan_rate=1):
-        next_id = ''
-        liked_items = []
-        for _x in range(0, scan_rate):
-            temp = self.getLikedMedia(next_id)
-            temp = self.LastJson
-            try:
-                next_id = temp["next_max_id"]
-                for item in temp["items"]:
-                    liked_items.append(item)
-            except KeyError:
-                break
-        return liked_items
+        return self.get_all(self.iterLikedMedia(max_pages=scan_rate))
 
 
 
@@ -938,93 +874,60 @@ class InstagramAPI:
         return ctime
    
     def prepare_direct(self, recipients, filepath, itemcode):
+        with open(filepath, 'rb') as item_file:
+            return self.prepare_direct_stream(recipients, item_file, os.path.getsize(filepath), itemcode, filepath)
+
+    # body is any file object or iterable of bytes, sent in chunks without loading it into memory
+    def prepare_direct_stream(self, recipients, body, length, itemcode, name):
         item_type = "video" if itemcode == 2 else "photo"
         itemext = "mp4" if itemcode == 2 else "jpeg"
-        baseheaders  = copy.deepcopy(self.s.headers)
-        try:
-            uploadId = self.UpId()
-         
-            #Initial Request
-
-            hashCode = str(hash(filepath) % 1000000000)
-            waterfallId = self.generateUUID(True)
-            entityName = uploadId + "_0_" + hashCode
-
-            uri = "https://i.instagram.com/rupload_ig{t}/{s}".format(t=item_type, s=entityName)
-            retryContext = self.getRetryContext()
-
-            uploadParams = json.dumps({'upload_media_height' : "0", # we could provide that
-                                    'direct_v2': "1",
-                                    'upload_media_width': "0", # we could provide that 
-                                    'upload_media_duration_ms': "0",
-                                    'upload_id': uploadId,
-                                    'retry_context': retryContext,
-                                    'media_type': str(itemcode)})
-
-
-            self.s.headers.update({'Accept-Language': 'en-US',
-                                    'X-IG-Capabilities': '3Q4=',
-                                    'X-IG-Connection-Type': 'WIFI',
-                                    'User-Agent': self.USER_AGENT,
-                                    'X-IG-App-ID': '567067343352427',
-                                    'X_FB_VIDEO_WATERFALL_ID': waterfallId,
-                                    'X-Instagram-Rupload-Params': uploadParams,
-                                    'Host': 'i.instagram.com',
-                                    'Connection': 'keep-alive'
-                                    })
-
-            response = self.s.get(uri)
-            if response.status_code != 200:
-                print("Request return " + str(response.status_code) + " error!")
-                self.s.headers = baseheaders 
-                time.sleep(20)
-                raise Exception('Handshake error')
-
-            # item Upload
-            item_bytes = open(filepath, 'rb').read()
-            entitytype = '{t}/{e}'.format(t=item_type, e=itemext)
-
-            self.s.headers.update({'Accept-Language': 'en-US',
-                                    'X-IG-Capabilities': '3Q4=',
-                                    'X-IG-Connection-Type': 'WIFI',
-                                    'User-Agent': self.USER_AGENT,
-                                    'X-IG-App-ID': '567067343352427',
-                                    'X-Entity-Type': entitytype,
-                                    'Offset': '0',
-                                    'X-Instagram-Rupload-Params': uploadParams,
-                                    'X-Entity-Name': entitytype,
-                                    'X-Entity-Length': str(len(item_bytes)),
-                                    'X_FB_VIDEO_WATERFALL_ID': waterfallId,
-                                    'Host': 'i.instagram.com',
-                                    'Connection': 'keep-alive',
-                                    'Expect': '100-continue'
-                                    })
-
-
-            response = self.s.post(uri, data=item_bytes)
-            if response.status_code != 200:
-                print("Request return " + str(response.status_code) + " error!")
-                self.s.headers = baseheaders 
-                raise Exception('Upload error')
+        uploadId = self.UpId()
+     
+        #Initial Request
 
+        hashCode = str(hash(name) % 1000000000)
+        waterfallId = self.generateUUID(True)
+        entityName = uploadId + "_0_" + hashCode
 
-            nice = dVideo(copy.deepcopy(self.s.headers), uploadId, recipients)
-            self.s.headers = baseheaders
-            return nice
-        except Exception as e:
-            try:
-                self.s.headers = baseheaders
-            except :
-                pass
-            raise e
+        uri = "https://i.instagram.com/rupload_ig{t}/{s}".format(t=item_type, s=entityName)
+        retryContext = self.getRetryContext()
+
+        uploadParams = json.dumps({'upload_media_height' : "0", # we could provide that
+                                'direct_v2': "1",
+                                'upload_media_width': "0", # we could provide that 
+                                'upload_media_duration_ms': "0",
+                                'upload_id': uploadId,
+                                'retry_context': retryContext,
+                                'media_type': str(itemcode)})
+
+        headers = self.compose_headers({'X_FB_VIDEO_WATERFALL_ID': waterfallId,
+                                        'X-Instagram-Rupload-Params': uploadParams})
+
+        response = Retry.get_policy("rupload").run(lambda: self.s.get(uri, headers=headers))
+        if response.status_code != 200:
+            print("Request return " + str(response.status_code) + " error!")
+            raise Exception('Handshake error')
+
+        # item Upload
+        entitytype = '{t}/{e}'.format(t=item_type, e=itemext)
+
+        headers = self.compose_headers(headers, {'X-Entity-Type': entitytype,
+                                                 'Offset': '0',
+                                                 'X-Entity-Name': entitytype,
+                                                 'X-Entity-Length': str(length),
+                                                 'Expect': '100-continue'})
+
+        response = self.s.post(uri, data=body, headers=headers)
+        if response.status_code != 200:
+            print("Request return " + str(response.status_code) + " error!")
+            raise Exception('Upload error')
+
+        return dVideo(uploadId, recipients)
         
 
 
     def send_direct(self, dVideo, itemcode):
         item_type = "video" if itemcode == 2 else "photo"
-        baseheaders  = copy.deepcopy(self.s.headers)
-        
-        self.s.headers = dVideo.header
         confuri = "https://i.instagram.com/api/v1/direct_v2/threads/broadcast/configure_{t}/".format(t=item_type)
 
         content = ""
@@ -1036,31 +939,22 @@ class InstagramAPI:
         content += "&upload_id=" + dVideo.upload_id
         content += "&recipient_users=%5B%5B" + dVideo.recipient + "%5D%5D"
 
-        self.s.headers.update({'Accept-Language': 'en-US',
-                           'X-IG-Capabilities': '3Q4=',
-                           'X-IG-Connection-Type': 'WIFI',
-                           'User-Agent': self.USER_AGENT,
-                           'X-IG-App-ID': '567067343352427',
-                           'retry_context': self.getRetryContext(),
-                           'Content-Type': 'application/x-www-form-urlencoded',
-                           'Host': 'i.instagram.com',
-                           'Content-Length': str(len(content)),
-                           'Expect': '100-continue'})
-
-        response = self.s.post(confuri, data=content)
+        headers = self.compose_headers({'retry_context': self.getRetryContext(),
+                                        'Content-Type': 'application/x-www-form-urlencoded',
+                                        'Expect': '100-continue'})
+
+        # 202 = still transcoding, asked again with backoff
+        response = Retry.get_policy("direct_v2/threads/broadcast/configure").run(lambda: self.s.post(confuri, data=content, headers=headers))
         if response.status_code != 200:
-            tried = 0
-            while response.status_code == 202 and not tried > 10:
-                print("Still Transcoding..")
-                time.sleep(5)
-                response = self.s.post(confuri, data=content)
-                tried+=1
-            if response.status_code != 200:
-                print("Request return " + str(response.status_code) + " error!")
-                self.s.headers = baseheaders
-                raise Exception('Unable to configure {t}: {e}'.format(t=item_type, e=response.text))
+            print("Request return " + str(response.status_code) + " error!")
+            raise Exception('Unable to configure {t}: {e}'.format(t=item_type, e=response.text))
 
-        self.s.headers = baseheaders
+    def compose_headers(self, *parts):
+        # new dict for one request: base profile + the given parts, the profile itself is never touched
+        headers = dict(self.BASE_HEADERS)
+        for part in parts:
+            headers.update(part)
+        return headers
 
     def is_user_following(self, username):
         try:
@@ -1075,10 +969,12 @@ class InstagramAPI:
             return True
         
         
-    def get_pending_inbox(self):
+    def get_pending_inbox(self, cursor=None):
         url = (
             "direct_v2/pending_inbox/?persistentBadging=true" "&use_unified_inbox=true"
         )
+        if cursor is not None:
+            url += "&cursor={0}".format(cursor)
         return self.SendRequest(url)
 
 
@@ -1093,15 +989,19 @@ class InstagramAPI:
 
     def approve_pending_thread(self, thread_id):
         data = self.json_data({"_uuid": self.uuid, "_csrftoken": self.token})
-        url = "https://i.instagram.com/api/v1/direct_v2/threads/{}/approve/".format(thread_id)
-        r = self.s.post(url, data=data)
-        self.LastResponse = r
-        if r.status_code == 200:
-            self.LastJson = json.loads(r.content)
+        endpoint = "direct_v2/threads/{}/approve/".format(thread_id)
+        r = Retry.get_policy(endpoint).run(lambda: self.s.post(self.API_URL + endpoint, data=data, headers=self.FORM_HEADERS))
+        return self.get_result(r)
 
-        return r.status_code == 200
+    # one request for a batch of message requests
+    def approve_pending_threads(self, thread_ids):
+        data = self.json_data({"thread_ids": json.dumps([str(t) for t in thread_ids])})
+        endpoint = "direct_v2/threads/approve_multiple/"
+        r = Retry.get_policy(endpoint).run(lambda: self.s.post(self.API_URL + endpoint, data=data, headers=self.FORM_HEADERS))
+        return self.get_result(r)
 
     def get_id_from_username(self, username):
-        if self.searchUsername(username):
-            return self.LastJson["user"]["pk"]
+        result = self.searchUsername(username)
+        if result:
+            return result["user"]["pk"]
         return None
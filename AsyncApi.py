@@ -0,0 +1,185 @@
+import os
+import json
+import asyncio
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from Api import InstagramAPI, parse_json
+from dVideo import dVideo
+import Retry
+import DebugCapture
+
+# asyncio variant of InstagramAPI, one event loop can drive many sessions
+# account state, signatures and cookies are the same as the sync class (cookies are written back to self.s),
+# only the transport is different: SendRequest is a coroutine, so the inherited request builders
+# (sendMessage, getv2Inbox, getv2Threads, get_pending_inbox, ...) return awaitables too
+# like the sync class, calls return the parsed json (None on failure)
+#
+#   connector = aiohttp.TCPConnector(limit_per_host=8)
+#   async with AsyncInstagramAPI.from_api(api, connector) as aapi:
+#       inbox = await aapi.getv2Inbox()
+
+class AsyncInstagramAPI(InstagramAPI):
+    # can point to a local stub server for tests
+    HOST = "https://i.instagram.com"
+    API_URL = HOST + "/api/v1/"
+    TIMEOUT = 60
+
+    def __init__(self, username, connector = None):
+        if aiohttp is None:
+            raise Exception("aiohttp is needed for the async client (pip install aiohttp)")
+        InstagramAPI.__init__(self, username)
+        self.connector = connector
+        self.session = None
+
+    @classmethod
+    def from_api(cls, api, connector = None):
+        # takes over the login of a sync client (e.g. loaded by APIStorage)
+        aapi = cls(api.username, connector)
+        for name in ("device_id", "uuid", "isLoggedIn", "username_id", "rank_token", "token"):
+            if hasattr(api, name):
+                setattr(aapi, name, getattr(api, name))
+        aapi.s = api.s
+        return aapi
+
+    async def open(self):
+        if self.session is not None:
+            return
+        self.session = aiohttp.ClientSession(connector = self.connector, connector_owner = self.connector is None,
+                                             cookie_jar = aiohttp.CookieJar(unsafe = True),
+                                             timeout = aiohttp.ClientTimeout(total = self.TIMEOUT))
+        self.session.cookie_jar.update_cookies({ c.name: c.value for c in self.s.cookies })
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def keep_cookies(self, response):
+        # csrftoken and session cookies stay in the requests jar, so APIStorage.save persists them
+        for name, morsel in response.cookies.items():
+            self.s.cookies.set(name, morsel.value, domain = '.instagram.com')
+
+    async def request(self, method, url, data = None, headers = None):
+        await self.open()
+        async with self.session.request(method, url, data = data, headers = headers or self.FORM_HEADERS, ssl = False) as response:
+            body = await response.read()
+            self.keep_cookies(response)
+            return response.status, body
+
+    def parse(self, status, body, url = None):
+        DebugCapture.ring.capture(url, status, body)
+        if status == 200:
+            try:
+                return parse_json(body)
+            except ValueError:
+                DebugCapture.ring.flush("parse_error")
+                raise
+        return None
+
+    async def SendRequest(self, endpoint, post = None, login = False):
+        if (not self.isLoggedIn and not login):
+            raise Exception("Not logged in!\n")
+
+        method = "POST" if post is not None else "GET"
+        status, body = await self.retry(endpoint, lambda: self.request(method, self.API_URL + endpoint, data = post))
+        if status != 200:
+            print("Request return " + str(status) + " error!")
+        return self.parse(status, body, self.API_URL + endpoint)
+
+    async def retry(self, endpoint, func):
+        return await Retry.get_policy(endpoint).run_async(func, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    async def approve_pending_thread(self, thread_id):
+        data = self.json_data({"_uuid": self.uuid, "_csrftoken": self.token})
+        endpoint = "direct_v2/threads/{}/approve/".format(thread_id)
+        status, body = await self.retry(endpoint, lambda: self.request("POST", self.API_URL + endpoint, data = data))
+        return self.parse(status, body, self.API_URL + endpoint)
+
+    async def approve_pending_threads(self, thread_ids):
+        data = self.json_data({"thread_ids": json.dumps([str(t) for t in thread_ids])})
+        endpoint = "direct_v2/threads/approve_multiple/"
+        status, body = await self.retry(endpoint, lambda: self.request("POST", self.API_URL + endpoint, data = data))
+        return self.parse(status, body, self.API_URL + endpoint)
+
+    async def prepare_direct(self, recipients, filepath, itemcode):
+        with open(filepath, 'rb') as item_file:
+            return await self.prepare_direct_stream(recipients, self.read_chunks(item_file), os.path.getsize(filepath), itemcode, filepath)
+
+    # the file in chunks, read in the default executor so the event loop never waits on the disk
+    async def read_chunks(self, item_file, size = 65536):
+        loop = asyncio.get_event_loop()
+        while True:
+            chunk = await loop.run_in_executor(None, item_file.read, size)
+            if not chunk:
+                return
+            yield chunk
+
+    # body: bytes, a file object or an async iterable of chunks
+    async def prepare_direct_stream(self, recipients, body, length, itemcode, name):
+        item_type = "video" if itemcode == 2 else "photo"
+        itemext = "mp4" if itemcode == 2 else "jpeg"
+        uploadId = self.UpId()
+        hashCode = str(hash(name) % 1000000000)
+        waterfallId = self.generateUUID(True)
+        uri = "{h}/rupload_ig{t}/{s}".format(h = self.HOST, t = item_type, s = uploadId + "_0_" + hashCode)
+
+        uploadParams = json.dumps({'upload_media_height': "0",
+                                   'direct_v2': "1",
+                                   'upload_media_width': "0",
+                                   'upload_media_duration_ms': "0",
+                                   'upload_id': uploadId,
+                                   'retry_context': self.getRetryContext(),
+                                   'media_type': str(itemcode)})
+
+        headers = self.compose_headers({'X_FB_VIDEO_WATERFALL_ID': waterfallId,
+                                        'X-Instagram-Rupload-Params': uploadParams})
+        status, _ = await self.retry("rupload", lambda: self.request("GET", uri, headers = headers))
+        if status != 200:
+            print("Request return " + str(status) + " error!")
+            raise Exception('Handshake error')
+
+        entitytype = '{t}/{e}'.format(t = item_type, e = itemext)
+        headers = self.compose_headers(headers, {'X-Entity-Type': entitytype,
+                                                 'Offset': '0',
+                                                 'X-Entity-Name': entitytype,
+                                                 'X-Entity-Length': str(length),
+                                                 'Content-Length': str(length)})
+        status, _ = await self.request("POST", uri, data = body, headers = headers)
+        if status != 200:
+            print("Request return " + str(status) + " error!")
+            raise Exception('Upload error')
+
+        return dVideo(uploadId, recipients)
+
+    async def send_direct(self, dVideo, itemcode):
+        item_type = "video" if itemcode == 2 else "photo"
+        confuri = self.API_URL + "direct_v2/threads/broadcast/configure_{t}/".format(t = item_type)
+
+        content = ""
+        content += "action=send_item"
+        content += "&client_context=" + str(self.generateUUID(True))
+        content += "&_csrftoken=" + self.token
+        content += "&video_result="
+        content += "&_uuid=" + self.uuid
+        content += "&upload_id=" + dVideo.upload_id
+        content += "&recipient_users=%5B%5B" + dVideo.recipient + "%5D%5D"
+
+        headers = self.compose_headers({'retry_context': self.getRetryContext(),
+                                        'Content-Type': 'application/x-www-form-urlencoded'})
+
+        # 202 = still transcoding, asked again with backoff
+        status, body = await self.retry("direct_v2/threads/broadcast/configure", lambda: self.request("POST", confuri, data = content, headers = headers))
+        if status != 200:
+            print("Request return " + str(status) + " error!")
+            raise Exception('Unable to configure {t}: {e}'.format(t = item_type, e = body.decode('utf-8', 'replace')))
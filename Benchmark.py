@@ -0,0 +1,116 @@
+import sys
+import json
+import time
+import random
+from PriorityQueue import PriorityQueue
+
+# Micro benchmarks behind the numbers in the commit messages, run them again after touching the code
+# python Benchmark.py [name ...], all benchmarks without a name
+
+def timed(func, repeat):
+    # best of repeat runs, in seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def inbox_payload(threads, items = 10):
+    # synthetic getv2Inbox response, every thread holds items media_share messages
+    def media_share(t, i):
+        return {
+            "item_id": "{t}{i:04d}".format(t = t, i = i),
+            "user_id": 1000 + t,
+            "timestamp": 1580000000000000 + t * 1000 + i,
+            "item_type": "media_share",
+            "media_share": {
+                "id": "2234{t}{i}_1000{t}".format(t = t, i = i),
+                "code": "B{t:05d}x{i:03d}".format(t = t, i = i),
+                "media_type": 2,
+                "caption": { "text": "caption " * 20 },
+                "user": { "pk": 5000 + i, "username": "owner{i}".format(i = i), "full_name": "Owner Name", "is_private": False },
+                "video_versions": [{ "type": k, "width": 640, "height": 640, "url": "https://example.invalid/v/{k}.mp4?" + "x" * 200 } for k in range(3)],
+                "image_versions2": { "candidates": [{ "width": w, "height": w, "url": "https://example.invalid/i/{w}.jpg?".format(w = w) + "y" * 200 } for w in (1080, 640, 320)] }
+            }
+        }
+    inbox = {
+        "threads": [{
+            "thread_id": "3400{t}".format(t = t),
+            "users": [{ "pk": 1000 + t, "username": "user{t}".format(t = t) }],
+            "items": [media_share(t, i) for i in range(items)]
+        } for t in range(threads)],
+        "has_older": False
+    }
+    return json.dumps({ "inbox": inbox, "snapshot_at_ms": 1580000000000, "status": "ok" }).encode("utf-8")
+
+def bench_parse():
+    # Api.parse_json candidates for the inbox responses
+    parsers = [
+        ("text+json", lambda body: json.loads(body.decode("utf-8"))),
+        ("json(bytes)", json.loads)
+    ]
+    try:
+        import orjson
+        parsers.append(("orjson", orjson.loads))
+    except ImportError:
+        print("orjson not installed, skipped")
+
+    for threads in (20, 50):
+        body = inbox_payload(threads)
+        results = []
+        for name, parse in parsers:
+            elapsed = timed(lambda: parse(body), 50)
+            results.append("{n} {t:.2f}ms".format(n = name, t = elapsed * 1000))
+        print("parse {t} threads ({k} KB): {r}".format(t = threads, k = len(body) // 1024, r = ", ".join(results)))
+
+def bench_queue():
+    # PriorityQueue operations on a queue of n upload items, time per operation
+    for n in (10000, 100000):
+        queue = PriorityQueue()
+        items = [{ "userid": i, "priority": random.randint(0, 5) } for i in range(n)]
+        ids = []
+
+        start = time.perf_counter()
+        for item in items:
+            ids.append(queue.push(item))
+        push = (time.perf_counter() - start) / n
+
+        # every tenth item changes its priority, another tenth is removed
+        random.shuffle(ids)
+        changed = ids[:n // 10]
+        removed = ids[n // 10:n // 5]
+
+        start = time.perf_counter()
+        for queue_id in changed:
+            queue.reprioritize(queue_id, random.randint(0, 5))
+        reprioritize = (time.perf_counter() - start) / len(changed)
+
+        start = time.perf_counter()
+        for queue_id in removed:
+            queue.remove(queue_id)
+        remove = (time.perf_counter() - start) / len(removed)
+
+        left = len(queue)
+        start = time.perf_counter()
+        while queue.pop() is not None:
+            pass
+        pop = (time.perf_counter() - start) / left
+
+        print("queue {n} items: push {p:.1f}us, remove {r:.1f}us, reprioritize {c:.1f}us, pop {o:.1f}us".format(
+            n = n, p = push * 1e6, r = remove * 1e6, c = reprioritize * 1e6, o = pop * 1e6))
+
+benchmarks = {
+    "parse": bench_parse,
+    "queue": bench_queue
+}
+
+if __name__ == "__main__":
+    random.seed(1)
+    for name in sys.argv[1:] or list(benchmarks):
+        if name not in benchmarks:
+            print("Unknown benchmark {n}, one of {b}".format(n = name, b = ", ".join(benchmarks)))
+            continue
+        benchmarks[name]()
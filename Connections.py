@@ -0,0 +1,101 @@
+import os
+import threading
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Keep-alive connection pools for the API and the CDN
+# every InstagramAPI session mounts sized per-host pools, media downloads share one CDN session
+# requests / new connections are counted per host, a request without a new connection reused a pooled one
+
+# (pool_connections = hosts kept, pool_maxsize = connections per host)
+API_POOL = (2, 4)
+CDN_POOL = (16, 8)
+API_PREFIXES = ["https://i.instagram.com", "https://upload.instagram.com"]
+# scontent-*.cdninstagram.com and instagram.*.fbcdn.net
+CDN_PREFIXES = ["https://scontent", "https://instagram."]
+
+class ConnectionStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # hosts[host] = [requests, new connections]
+        self.hosts = {}
+
+    def count(self, host, index):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = [0, 0]
+            self.hosts[host][index] += 1
+
+    def add_request(self, host):
+        self.count(host, 0)
+
+    def add_connection(self, host):
+        self.count(host, 1)
+
+    def get_stats_text(self):
+        with self.lock:
+            total = [sum(h[0] for h in self.hosts.values()), sum(h[1] for h in self.hosts.values())]
+            api = self.hosts.get("i.instagram.com", [0, 0])
+        reused = max(total[0] - total[1], 0)
+        rate = reused * 100 // total[0] if total[0] > 0 else 0
+        return "Connections: {r} requests, {n} new connections, {p}% reused (api {a}/{c})".format(
+            r = total[0], n = total[1], p = rate, a = api[0], c = api[1])
+
+stats = ConnectionStats()
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        stats.add_connection(self.host)
+        return super()._new_conn()
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        stats.add_connection(self.host)
+        return super()._new_conn()
+
+class PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = { "http": CountingHTTPConnectionPool, "https": CountingHTTPSConnectionPool }
+
+    def send(self, request, **kwargs):
+        stats.add_request(urllib.parse.urlsplit(request.url).hostname)
+        return super().send(request, **kwargs)
+
+def mount(session, prefixes, size):
+    for prefix in prefixes:
+        session.mount(prefix, PooledAdapter(pool_connections = size[0], pool_maxsize = size[1]))
+
+def create_session():
+    # session for one logged in account
+    session = requests.Session()
+    mount(session, API_PREFIXES, API_POOL)
+    mount(session, CDN_PREFIXES, CDN_POOL)
+    # anything else (e.g. other media hosts) still keeps its connections alive
+    mount(session, ["https://", "http://"], CDN_POOL)
+    return session
+
+cdn = None
+cdn_lock = threading.Lock()
+
+def cdn_session():
+    # shared by all threads for media downloads, urllib3 pools are thread safe
+    global cdn
+    with cdn_lock:
+        if cdn is None:
+            cdn = requests.Session()
+            mount(cdn, CDN_PREFIXES + ["https://", "http://"], CDN_POOL)
+        return cdn
+
+def reset_after_fork():
+    # a forked worker process must not share the parent's sockets
+    global cdn, cdn_lock
+    cdn = None
+    cdn_lock = threading.Lock()
+
+# not available on Windows, there are no forked workers there
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child = reset_after_fork)
@@ -0,0 +1,57 @@
+import os
+import time
+import json
+import random
+import logging
+import threading
+from collections import deque
+from pathlib import Path
+
+# Ring buffer of recent raw API responses for post mortems
+# nothing touches the disk until flush(): on a parse error, the !dump admin command or SIGUSR1
+# successful responses are sampled, errors are always kept, bounded by amount of entries and total bytes
+
+class DebugCapture(object):
+    def __init__(self, entries = 20, max_bytes = 8 * 1024 * 1024, sample = 0.25, folder = "debug"):
+        self.entries = entries
+        self.max_bytes = max_bytes
+        self.sample = sample
+        self.folder = folder
+        self.lock = threading.Lock()
+        # (time, url, status, raw body), oldest first
+        self.buffer = deque()
+        self.used = 0
+        self.flushes = 0
+
+    def capture(self, url, status, content, force = False):
+        if not force and status == 200 and random.random() >= self.sample:
+            return
+        with self.lock:
+            self.buffer.append((time.time(), url, status, content))
+            self.used += len(content)
+            while len(self.buffer) > self.entries or (self.used > self.max_bytes and len(self.buffer) > 1):
+                self.used -= len(self.buffer.popleft()[3])
+
+    def flush(self, reason):
+        with self.lock:
+            entries = list(self.buffer)
+            self.flushes += 1
+        if len(entries) == 0:
+            return None
+
+        os.makedirs(self.folder, exist_ok = True)
+        path = Path(self.folder, "capture_{t}_{r}.json".format(t = time.strftime("%Y%m%d_%H%M%S"), r = reason))
+        with open(path, "w") as fp:
+            json.dump([{ "time": e[0], "url": e[1], "status": e[2], "body": e[3].decode("utf-8", "replace") } for e in entries], fp)
+        logging.info("Wrote {n} captured responses to {p} ({r})".format(n = len(entries), p = path, r = reason))
+        return path
+
+    def flush_async(self, reason):
+        # for signal handlers, the interrupted code may hold the lock
+        threading.Thread(target = self.flush, args = (reason,)).start()
+
+    def get_stats_text(self):
+        with self.lock:
+            return "Debug capture: {n} responses, {k}KB, {f} dumps".format(n = len(self.buffer), k = self.used // 1024, f = self.flushes)
+
+ring = DebugCapture()
@@ -0,0 +1,151 @@
+import os
+import time
+import json
+import logging
+import threading
+
+# Incremental inbox sync, keeps the last seen item (id + timestamp) of every thread
+# the inbox only carries the latest few items of each thread, if all of them are new
+# the thread is paged back with getv2Threads and its cursor until the last seen item is reached
+# new items of all threads are returned oldest first, so several posts sent between two polls are all handled
+# threads never seen before count every item after the start watermark (the first sync) as new,
+# only the very first sync without any state takes just the latest item of each thread
+# threads dropped from the state (above max_threads) leave a floor, their items up to it count as seen
+# state is saved to a small json file, a restart continues where it stopped
+
+class InboxSync(object):
+    # items per thread in the inbox response, older ones are fetched by cursor only when needed
+    THREAD_MESSAGE_LIMIT = 5
+    # older pages fetched per thread and poll at most
+    PAGE_LIMIT = 5
+
+    # allow(): asked before every older page, False skips the thread until the next poll
+    def __init__(self, api, path = "inbox_state", max_threads = 5000, allow = None):
+        self.api = api
+        self.allow = allow if allow is not None else lambda: True
+        self.path = str(path)
+        self.max_threads = max_threads
+        self.lock = threading.Lock()
+        # threads[thread_id] = [last seen item_id, last seen timestamp]
+        self.threads = {}
+        # timestamp of the first sync, None until there is any state
+        self.started = None
+        # newest timestamp of the threads dropped from the state, None until one is dropped
+        self.floor = None
+        self.changed = False
+        self.new_total = 0
+        self.pages_total = 0
+        self.skipped = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as fp:
+                state = json.load(fp)
+        except ValueError:
+            logging.warning("Inbox state is broken, starting with the latest items")
+            return
+        if "threads" in state and "started" in state:
+            self.threads = state["threads"]
+            self.started = state["started"]
+            self.floor = state.get("floor")
+        else:
+            # plain thread map of older versions, everything up to the newest seen item was handled
+            self.threads = state
+            self.started = max([t[1] for t in state.values()], default = None)
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            if len(self.threads) > self.max_threads:
+                newest = sorted(self.threads.items(), key = lambda t: t[1][1], reverse = True)
+                dropped = newest[self.max_threads][1][1]
+                self.floor = dropped if self.floor is None else max(self.floor, dropped)
+                self.threads = dict(newest[:self.max_threads])
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as fp:
+                json.dump({ "started": self.started, "floor": self.floor, "threads": self.threads }, fp)
+            os.replace(temp_path, self.path)
+            self.changed = False
+
+    @staticmethod
+    def get_timestamp(item):
+        return int(item["timestamp"])
+
+    def get_since(self, thread_id, pending = False):
+        # timestamp items must be newer than, None = only the latest item
+        state = self.threads.get(thread_id)
+        if state is not None:
+            return state[1]
+        if self.floor is not None:
+            # the thread may have been dropped from the state, everything up to the floor was handled
+            return self.floor if pending or self.started is None else max(self.started, self.floor)
+        if pending:
+            # an unanswered message request, none of its items was handled
+            return 0
+        return self.started
+
+    def new_items(self, thread, pending = False):
+        # new items of one thread, oldest first
+        thread_id = thread["thread_id"]
+        items = thread.get("items", [])
+        if len(items) == 0:
+            return []
+        since = self.get_since(thread_id, pending)
+        if since is None:
+            # no state at all yet, only the latest item is a request (same as before the sync)
+            return items[:1]
+
+        fresh = [i for i in items if self.get_timestamp(i) > since]
+        page = thread
+        pages = 0
+        while len(fresh) > 0 and self.get_timestamp(page["items"][-1]) > since and page.get("has_older") and pages < self.PAGE_LIMIT:
+            # the whole page is new, there can be more unseen items before it
+            if not self.allow():
+                # out of requests, nothing of this thread is marked seen, the next poll pages it again
+                with self.lock:
+                    self.pages_total += pages
+                    self.skipped += 1
+                return []
+            older = self.api.getv2Threads(thread_id, page.get("oldest_cursor"))
+            if older is None or len(older["thread"].get("items", [])) == 0:
+                break
+            page = older["thread"]
+            fresh += [i for i in page["items"] if self.get_timestamp(i) > since]
+            pages += 1
+
+        with self.lock:
+            self.pages_total += pages
+        fresh.sort(key = self.get_timestamp)
+        return fresh
+
+    # pending: threads of the pending inbox, all their items are new
+    def sync(self, inbox, pending = False):
+        # [(thread, item)] of every new item in the inbox, oldest first
+        found = []
+        for thread in inbox["inbox"]["threads"]:
+            for item in self.new_items(thread, pending):
+                found.append((thread, item))
+        found.sort(key = lambda f: self.get_timestamp(f[1]))
+        with self.lock:
+            self.new_total += len(found)
+            if self.started is None:
+                # items of threads that show up later are new from here on
+                self.started = int(inbox.get("snapshot_at_ms", time.time() * 1000)) * 1000
+                self.changed = True
+        return found
+
+    def seen(self, thread, item):
+        with self.lock:
+            state = self.threads.get(thread["thread_id"])
+            if state is None or self.get_timestamp(item) > state[1]:
+                self.threads[thread["thread_id"]] = [item["item_id"], self.get_timestamp(item)]
+                self.changed = True
+
+    def get_stats_text(self):
+        with self.lock:
+            return "Inbox sync: {t} threads tracked, {n} new items, {p} older pages fetched, {s} threads put off".format(
+                t = len(self.threads), n = self.new_total, p = self.pages_total, s = self.skipped)
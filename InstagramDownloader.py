@@ -5,11 +5,21 @@ import pickle
 import threading
 import random
 import re
-
-import requests
-from moviepy.video.io.ffmpeg_tools import ffmpeg_extract_subclip
+import signal
 
 from Delay import Delay
+from Scheduler import Scheduler
+from QueueJournal import QueueJournal
+from MediaStream import MediaStream
+from MediaCache import MediaCache
+from Prefetcher import Prefetcher
+from InboxSync import InboxSync
+from PollScheduler import PollScheduler
+from Transcoder import Transcoder, cut_video
+from dVideo import dVideo
+import Connections
+import Retry
+import DebugCapture
 import Language
 from MongoStorage import Storage, APIStorage
 
@@ -31,25 +41,34 @@ logging.getLogger().addHandler(handler)
 
 import pickle
 
-# TODO: change queue list into class variable instead of instance variable,
-# reducing need of separate queue and just append to list
 class Uploader(object):
-    def __init__(self, API, config, delay, number, storage, queue_file):
+    # queued requests for the same media delivered with a single upload
+    MAX_SHARED_DELIVERY = 10
+    # how long an upload_id is reused for later requests of the same media
+    UPLOAD_ID_TTL = 600
+
+    def __init__(self, API, config, delay, number, storage, scheduler, cache, transcoder):
         self.api = API
         self.cfg = config
         self.delay = delay
         self.number = number
         self.storage = storage
-        self.queue_file = queue_file
+        self.scheduler = scheduler
+        self.scheduler.register(number)
+        self.cache = cache
+        self.transcoder = transcoder
+        # uploaded[media_key] = (dVideo, upload time)
+        self.uploaded = {}
         self.upload_worker = threading.Thread(target=self.upload_worker_func)
         self.running = False
-        self.queue = []
-        # queue_count[username] = remaining_left
-        self.queue_count = {}
+        # cuts the sleep between uploads short on stop
+        self.stopped = threading.Event()
 
         self.sleep = [0,60]
 
         self.errors = 0
+        # request whose delivery raised in upload_file
+        self.failed_target = None
 
     def start(self):
         self.running = True
@@ -57,52 +76,20 @@ class Uploader(object):
 
     def stop(self):
         self.running = False
+        self.stopped.set()
 
-
-    def extract_priority(self, json):
-        if "priority" in json:
-            return int(json["priority"])
-        return 0
-
-    def queue_contains(self, itemid):
-        for item in self.queue:
-            if item["item_id"] == itemid:
-                return True
-        return False
-
-    def queue_contains_post(self, media_id, username):
-        for item in self.queue:
-            if item["username"] == username:
-                if "media_id" in item and item["media_id"] == media_id:
-                    return True
-        return False
-
-    # TODO: now only push to instance, in future should push to class var
-    def add_to_queue(self, item):
-        self.queue.append(item)
-        self.increase_queue_count(item)
-
-    def increase_queue_count(self, item):
-        userid = str(item["userid"])
-        if userid not in self.queue_count:
-            self.queue_count[str(userid)] = 0
-        self.queue_count[str(userid)] += 1
-    
-    def remove_from_queue(self, item):
-        self.queue.remove(item)
-        self.queue_count[str(item["userid"])] -= 1
-
-    def load_queue(self, queue):
-        self.queue = queue
-        for item in queue:
-            self.increase_queue_count(item)
+    # waits for the upload in progress
+    def join(self):
+        if self.upload_worker.is_alive():
+            self.upload_worker.join()
 
     def reload_api(self):
         self.api = self.storage.load()
         logging.info("Reloaded uploader #{}".format(self.storage.session_id))
 
 
-    def send_media(self, url, itemid, mediatype, media_id, userid, username, download_from, sent, cut=False):
+    # pinned items are only uploaded by this session, others go to the shared queue
+    def send_media(self, url, itemid, mediatype, media_id, userid, username, download_from, sent, cut=False, pinned=False):
         user = self.cfg.get_user(userid)
         
         item = {"priority": user["priority"],
@@ -115,35 +102,113 @@ class Uploader(object):
                 "userid": userid,
                 "username": username,
                 "download_from": download_from}
-
-        self.add_to_queue(item)
+        item["media_key"] = MediaCache.get_key(item, "cut" if cut else "")
+
+        # videos to cut wait outside the queue until the transcoder has the cut version ready
+        self.scheduler.add(item, self.number if pinned else None, hold = cut)
+        if cut:
+            self.transcoder.submit(item)
+
+    def cut_media(self, item, key):
+        # normally done by the transcoder already, only used when its cut failed or got evicted
+        # cut video comes from the cached original if there is one (e.g. prefetched)
+        raw_key = MediaCache.get_key(item)
+        raw_path = self.cache.acquire(raw_key)
+        if raw_path is None:
+            raw_path = self.cache.store(raw_key, 2, MediaStream(item["url"]).save)
+        try:
+            return self.cache.store(key, 2, lambda path: cut_video(raw_path, path))
+        finally:
+            self.cache.release(raw_key)
+
+    def stream_media(self, item, key, item_code):
+        # stream chunks from the CDN straight into the upload, copying them into the cache on the way
+        temp_path = self.cache.temp_path(key, item_code)
+        path = None
+        try:
+            with MediaStream(item["url"]) as stream:
+                with open(temp_path, "wb") as fp:
+                    stream.tee = fp
+                    xd = self.api.prepare_direct_stream(item["userid"], stream, len(stream), item_code, item["url"])
+            if stream.is_complete():
+                path = self.cache.commit(key, item_code, temp_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return xd, path
 
     # filetype: photo (1) = .jpg, video (2) = .mp4
-    def upload_file(self, item, filename, item_code):
-        item_type = "video" if item_code == 2 else "photo"
-        filetype = "mp4" if item_code == 2 else "jpg"
-        full_path = str(Path("./{i}s/{f}.{t}".format(i = item_type, f=filename, t=filetype)))
-        item_file = requests.get(item["url"])
-        open(full_path, "wb").write(item_file.content)
-
-        # if video length exceeds 60 seconds
-        if "cut" in item and item["cut"]:
-            new_path = str(Path("./{i}s/{f}_cut.mp4".format(i = item_type, f=filename)))
-            ffmpeg_extract_subclip(full_path, 0, 59, targetname=new_path)
-            os.remove(full_path)
-            full_path = new_path
-        
-        xd = self.api.prepare_direct(item["userid"], full_path, item_code)
+    def prepare_media(self, item, item_code, key):
+        # if video length exceeds 60 seconds, only the cut version is needed
+        cut = "cut" in item and item["cut"]
 
+        # a cache hit skips both the download and the cut
+        path = self.cache.acquire(key)
         try:
-            self.api.send_direct(xd, item_code)
-        except: # Exception as e:
-            rnd = random.randint(1, 20) 
-            time.sleep(rnd)
-            self.api.send_direct(xd, item_code)
-        
+            if path is not None:
+                xd = self.api.prepare_direct(item["userid"], path, item_code)
+            elif cut:
+                path = self.cut_media(item, key)
+                xd = self.api.prepare_direct(item["userid"], path, item_code)
+            else:
+                xd, path = self.stream_media(item, key, item_code)
+        finally:
+            if path is not None:
+                self.cache.release(key)
+        return xd
+
+    def get_uploaded(self, key):
+        now = time.time()
+        for k in [k for k, v in self.uploaded.items() if now - v[1] > self.UPLOAD_ID_TTL]:
+            del self.uploaded[k]
+        return self.uploaded[key][0] if key in self.uploaded else None
+
+    # uploads the media once and configures it for the item and every extra request of the same media
+    # the request that failed is left in self.failed_target
+    def upload_file(self, item, extras = []):
+        item_code = item["media_type"]
+        key = item["media_key"] if "media_key" in item else MediaCache.get_key(item, "cut" if item.get("cut") else "")
+
+        self.failed_target = item
+        xd = self.get_uploaded(key)
+        reused = xd is not None
+        if not reused:
+            xd = self.prepare_media(item, item_code, key)
+            self.uploaded[key] = (xd, time.time())
+
+        for target in [item] + extras:
+            self.failed_target = target
+            if target is not item:
+                # still one DM after another, keep some space between them
+                time.sleep(random.randint(2, 5))
+            try:
+                self.deliver(target, xd, item_code)
+            except Exception:
+                if not reused:
+                    raise
+                # send_direct refused the reused upload_id (may have expired), upload again and retry once
+                del self.uploaded[key]
+                xd = self.prepare_media(item, item_code, key)
+                self.uploaded[key] = (xd, time.time())
+                reused = False
+                self.deliver(target, xd, item_code)
+
+            # sent, a failure from here on must not send the media again
+            try:
+                self.delivered(target, item_code)
+            except Exception as e:
+                logging.error("After delivery to @{u}: {e}".format(u = target["username"], e = str(e)))
+            self.scheduler.complete(self.number, target)
+
+    def deliver(self, item, xd, item_code):
+        # retried by the configure policy, see Retry
+        self.api.send_direct(dVideo(xd.upload_id, str(item["userid"])), item_code)
+
+    def delivered(self, item, item_code):
+        item_type = "video" if item_code == 2 else "photo"
+
         # the queue is removed ONLY when the upload is complete
-        if self.queue_count[str(item["userid"])] == 1:
+        if self.scheduler.remaining(item["userid"]) == 1:
             self.api.sendMessage(str(item["userid"]), Language.get_text("promote"))
             logging.info("Send promotion to @{u}!".format(u=item["username"]))
         
@@ -152,46 +217,50 @@ class Uploader(object):
 
         logging.info("Timespan since sent {t}: {s}ms".format(t=item_type, s=str((time.time() * 1000 // 1) - item["sent"] // 1000)))
         self.delay.capture_delay(int(time.time() - item["sent"] // 1000000), item["priority"])
-        if os.path.exists(full_path):
-            os.remove(full_path)
 
     def upload_worker_func(self):
         while self.running:
-            if len(self.queue) == 0:
+            item = self.scheduler.peek(self.number)
+            if item is None:
                 time.sleep(1)
                 continue
 
-            self.queue.sort(key=self.extract_priority, reverse=True)
+            if item["priority"] > 1:
+                self.sleep = [5, 15]
+            rnd = random.randint(self.sleep[0], self.sleep[1]) 
+            self.stopped.wait(rnd)
+            if not self.running:
+                break
+
+            # claim after the sleep, whatever is best now (another session may have taken the peeked item)
+            item = self.scheduler.claim(self.number)
+            if item is None:
+                continue
+            extras = self.scheduler.claim_same_media(self.number, item, self.MAX_SHARED_DELIVERY)
 
-            item = {}
-            filename = None
-            full_path = ""
             try:
-                item = self.queue[0]
-                if item["priority"] > 1:
-                    self.sleep = [5, 15]
-                rnd = random.randint(self.sleep[0], self.sleep[1]) 
-                time.sleep(rnd)
-                filename = str(int(round(time.time() * 10000)))
-                self.upload_file(item, filename, item["media_type"])
+                self.upload_file(item, extras)
 
                 self.sleep = [10, 30]
-                self.remove_from_queue(item)
             except Exception as e:
-                if os.path.exists(full_path):
-                    os.remove(full_path)
-                logging.error("Error with @{u} {er}".format(er=str(e), u=item["username"]))
-                if not "few minutes" in str(e):
-                    self.remove_from_queue(item)
+                logging.error("Error with @{u} {er}".format(er=str(e), u=self.failed_target["username"]))
+                if "few minutes" in str(e):
+                    # this session is throttled, hand the items back so an idle session can take them
+                    self.scheduler.release(self.number)
+                else:
+                    # drop the request that failed, extras not delivered yet go back to the queue
+                    self.scheduler.complete(self.number, self.failed_target)
+                    self.scheduler.release(self.number)
                 self.reload_api()
                 self.sleep = [30, 120]
             time.sleep(1)
 
 
 class InboxItem(object):
-    def __init__(self, json):
+    # item: one item of the thread, the latest one if not given
+    def __init__(self, json, item = None):
         self.json = json
-        self.item = json["items"][0]
+        self.item = item if item is not None else json["items"][0]
         self.users = json["users"]
         self.is_group = json["is_group"]
         self.item_type = self.item["item_type"]
@@ -265,17 +334,29 @@ class InboxItem(object):
 
 
 class InboxHandler(object):
-    def __init__(self, API, config, delay, admins, uploader, d_uploader):
+    # message requests approved with one request
+    PENDING_BATCH = 20
+    # pending inbox pages handled per poll at most
+    PENDING_PAGES = 10
+
+    def __init__(self, API, config, delay, admins, uploader, scheduler):
         self.api = API
         self.cfg = config
         self.delay = delay
         self.count = 0
+        self.scheduler = scheduler
+        # components with get_stats_text(), reported by !stats
+        self.stats_sources = []
         self.uploader_list = uploader
         self.uploader = self.uploader_list[0]
 
         self.admins = admins
 
         self.first = True
+        self.running = True
+        self.poller = PollScheduler()
+        # older thread pages only while the account has requests left
+        self.inbox_sync = InboxSync(API, allow = self.poller.allow)
 
     def is_inbox_valid(self, json_inbox):
         millis = time.time() // 1000
@@ -290,47 +371,46 @@ class InboxHandler(object):
         return os.path.exists(Path("./multi/{u}.json".format(u=str(userid))))
 
     def run(self):
-        while True:
+        while self.running:
             try:
-                try:
-                    # TODO: change to push notification based
-                    # currently will only retreive the latest message
-                    # ignoring the previous one if user send multiple within 15 second period
-                    self.handle_inbox()
-                    time.sleep(15)
-                except Exception as e:
-                    logging.error("Handle Inbox crashed:  {0}".format(str(e)))
-                    time.sleep(10)
-            except:
-                time.sleep(10)
-        for u in self.uploader_list:
-            u.running = False
-        logging.error("dead, oof")
+                # TODO: change to push notification based
+                new_items, failed = self.handle_inbox()
+                self.poller.record(new_items, failed)
+            except Exception as e:
+                logging.error("Handle Inbox crashed:  {0}".format(str(e)))
+                self.poller.record(0, True)
+            if self.running:
+                self.poller.wait()
+        logging.info("Inbox stopped")
 
+    # safe to call from a signal handler, run() returns after the current poll
+    def stop(self):
+        self.running = False
+        self.poller.wake()
+
+    # replies count against the request ceiling of the inbox account like the polls
+    def send_message(self, userid, text):
+        self.poller.acquire()
+        return self.api.sendMessage(userid, text)
+
+    # only used for pinned items, everything else goes through the shared queue
     def get_uploader(self):
         upl = self.uploader_list[0]
         for u in self.uploader_list:
-            if len(upl.queue) > len(u.queue):
+            if self.scheduler.pinned_load(upl.number) > self.scheduler.pinned_load(u.number):
                 upl = u
 
         return upl
 
     def is_post_queued(self, media_id, username):
-        for upl in self.uploader_list:
-            if upl.queue_contains_post(media_id, username):
-                return True
-        return False
+        return self.scheduler.contains_post(media_id, username)
 
     def queue_total(self, do_count=False):
-        total = 0
-        for upl in self.uploader_list:
-            q = len(upl.queue)
-            total += q
-            if do_count:
-                print(str(q), end=" ")
+        total = len(self.scheduler)
         if do_count:
-            print("Total {0}".format(total))
+            print("{0} Total {1}".format(self.scheduler.count_text(), total))
         return total
+
             
     #item handler
 
@@ -344,7 +424,7 @@ class InboxHandler(object):
         self.cfg.user_set_itemtime(item.userid, username, item.timestamp)
 
         if not bypass and self.is_post_queued(item.get_media()["pk"], username):
-            self.api.sendMessage(str(item.userid), "That post is already in the queue.")
+            self.send_message(str(item.userid), "That post is already in the queue.")
             return
 
         if not bypass:
@@ -356,19 +436,13 @@ class InboxHandler(object):
         duration = search_item["video_duration"] if is_video else 0
 
         if duration >= 70:
-            self.api.sendMessage(str(item.userid), Language.get_text("video_to_long"))
+            self.send_message(str(item.userid), Language.get_text("video_to_long"))
             return
         elif send_received:
             # send placed in queue message
-            self.api.sendMessage(str(item.userid), Language.get_text("in_queue").format(self.queue_total()))
+            self.send_message(str(item.userid), Language.get_text("in_queue").format(self.queue_total()))
 
-        uploader = self.uploader
-        
-        if not same_queue:
-            uploader = self.get_uploader()
-            self.uploader = uploader
-            
-        uploader.send_media(url, item.item["item_id"], item_code, item.get_media()["pk"], str(item.userid),  username, item.get_item_poster(), item.timestamp, cut = duration >= 60)
+        self.uploader.send_media(url, item.item["item_id"], item_code, item.get_media()["pk"], str(item.userid),  username, item.get_item_poster(), item.timestamp, cut = duration >= 60, pinned = same_queue)
         logging.info("Added @{u} to queue".format(u=username))
 
     def handle_text(self, username, item):
@@ -380,7 +454,7 @@ class InboxHandler(object):
 
         #ADMINCOMMANDS
         if username not in self.admins:
-            self.api.sendMessage(str(item.userid), Language.get_text("dm"))
+            self.send_message(str(item.userid), Language.get_text("dm"))
             return
         
         message = "Commapnd not found, please use !help to list out all commands available"
@@ -389,34 +463,31 @@ class InboxHandler(object):
             pusername = args[1]
             amount = args[2] if len(args) >= 3 else 1
             now = self.cfg.upgrade_priority(pusername, amount)
-            self.api.sendMessage(str(item.userid), "@{u} now has priority lvl {lv}".format(u=pusername, lv = now))
+            self.scheduler.reprioritize_user(pusername, now)
+            self.send_message(str(item.userid), "@{u} now has priority lvl {lv}".format(u=pusername, lv = now))
         elif text.startswith("!downgrade"):
             args = text.split(" ")
             pusername = args[1]
             amount = args[2] if len(args) >= 3 else 1
             now = self.cfg.downgrade_priority(pusername, amount)
-            self.api.sendMessage(str(item.userid), "@{u} now has priority lvl {lv}".format(u=pusername, lv = now))
+            self.scheduler.reprioritize_user(pusername, now)
+            self.send_message(str(item.userid), "@{u} now has priority lvl {lv}".format(u=pusername, lv = now))
         elif text.startswith("!remove"):
             pusername = text.replace("!remove ", "")
-            total = 0
-            for upl in self.uploader_list:
-                for i in upl.queue:
-                    if i["username"] == pusername:
-                        total += 1
-                        upl.queue.remove(i)
-            self.api.sendMessage(str(item.userid), "Removed {t} queue items from that user!".format(t=total))
+            total = self.scheduler.remove_user(pusername)
+            self.send_message(str(item.userid), "Removed {t} queue items from that user!".format(t=total))
         elif text.startswith("!reset"):
             self.delay.reset_delay()
-            self.api.sendMessage(str(item.userid), "Resetted!")
+            self.send_message(str(item.userid), "Resetted!")
         elif text.startswith("!day"):
             # TODO: add to see custom day
             downloads = self.cfg.get_day_download()
-            self.api.sendMessage(str(item.userid), "{dl} downloads today!".format(dl = downloads))
+            self.send_message(str(item.userid), "{dl} downloads today!".format(dl = downloads))
         elif text.startswith("!top"):
             message = ""
             query = text.replace("!top ", "").split(" ")
             qlen = len(query)
-            amount = query[qlen] if qlen > 1 and query[qlen - 1].isdigit() else 5
+            amount = int(query[qlen - 1]) if qlen > 1 and query[qlen - 1].isdigit() else 5
             username = query[1][1:] if len(query) >= 2 and query[1].startswith("@") else ""
 
             if text == "!top" or query[0] == "":
@@ -444,14 +515,7 @@ class InboxHandler(object):
             elif query[0] == "requested":
                 message = self.cfg.get_requested_info(username, amount)
             elif query[0] == "queue":
-                result = {}
-                for u in self.uploader_list:
-                    for q in u.queue:
-                        if q["username"] not in result.keys():
-                            result[q["username"]] = 1
-                        else:
-                            result[q["username"]] += 1
-                xd = sorted(result.items(), key=lambda x: x[1], reverse=True)[:amount]
+                xd = self.scheduler.top_users(amount)
 
                 message = "Top {} users in download queue:".format(amount)
                 index = 1
@@ -462,7 +526,7 @@ class InboxHandler(object):
 
                 if index == 1:
                     message = "Download queue is empty"
-            self.api.sendMessage(str(item.userid), message)
+            self.send_message(str(item.userid), message)
         elif text.startswith("!delay"):
             msg = ""
             for i in range(0, 100):
@@ -470,7 +534,15 @@ class InboxHandler(object):
                 if d != 0:
                     msg += "Priority Lv {lvl} - {delay}s\r\n".format(lvl=i, delay=d)
             msg = ("Current average delay:\r\n" + msg) if msg != "" else Language.get_text("admin.no_data").format("delay")
-            self.api.sendMessage(str(item.userid), msg)
+            self.send_message(str(item.userid), msg)
+        elif text.startswith("!stats"):
+            msg = "\r\n".join([source.get_stats_text() for source in self.stats_sources])
+            msg = msg if msg != "" else Language.get_text("admin.no_data").format("stats")
+            self.send_message(str(item.userid), msg)
+        elif text.startswith("!dump"):
+            path = DebugCapture.ring.flush("admin")
+            msg = "Captured responses written to {0}".format(path) if path is not None else Language.get_text("admin.no_data").format("captured responses")
+            self.send_message(str(item.userid), msg)
         elif text.startswith("!help"):
             message = ""
         else:
@@ -483,7 +555,7 @@ class InboxHandler(object):
         self.cfg.user_set_itemtime(item.userid, username, item.timestamp)
 
 
-        self.api.sendMessage(str(item.userid), Language.get_text("links_not_supported"))
+        self.send_message(str(item.userid), Language.get_text("links_not_supported"))
         return
 
     def handle_placeholder(self, username, item):
@@ -496,12 +568,12 @@ class InboxHandler(object):
                 username_requested = "".join([i for i in msg.split() if i.startswith("@")][0])[1:]
                 self.cfg.requested_add_request(username_requested, username)
             
-                self.api.sendMessage(str(item.userid), Language.get_text("requested"))
+                self.send_message(str(item.userid), Language.get_text("requested"))
                 return
             elif "deleted" in msg:
-                self.api.sendMessage(str(item.userid), Language.get_text("deleted"))
+                self.send_message(str(item.userid), Language.get_text("deleted"))
             else:
-                self.api.sendMessage(str(item.userid), Language.get_text("blocked"))
+                self.send_message(str(item.userid), Language.get_text("blocked"))
         return
 
     def handle_story(self, username, item):
@@ -522,7 +594,7 @@ class InboxHandler(object):
             self.cfg.user_set_itemtime(item.userid, username, item.timestamp)
             username_requested = "".join([i for i in msg.split() if i.startswith("@")][0])[1:]
             self.cfg.requested_add_request(username_requested, username)
-            self.api.sendMessage(str(item.userid), Language.get_text("requested"))
+            self.send_message(str(item.userid), Language.get_text("requested"))
             return
 
         self.handle_media(username, item, item.get_media_type())
@@ -535,10 +607,12 @@ class InboxHandler(object):
             if self.cfg.get_user(item.userid)["latest_item_time"] == item.timestamp:
                 return
             if self.queue_total() > 2000:
-                self.api.sendMessage(str(item.userid), "Slideposts are currently disabled due to heavy server load. Please come back later.")
+                self.send_message(str(item.userid), "Slideposts are currently disabled due to heavy server load. Please come back later.")
                 self.cfg.user_set_itemtime(item.userid, username, item.timestamp)
                 return
 
+            # every slide goes through the same session to keep them in order
+            self.uploader = self.get_uploader()
             count = 0
             for i in item.get_media()["carousel_media"]:
                 self.handle_media(username, item, i["media_type"], True, i, True, count == 0)
@@ -552,7 +626,7 @@ class InboxHandler(object):
             return
         self.cfg.user_set_itemtime(item.userid, username, item.timestamp)
         if item.item["profile"]["has_anonymous_profile_picture"]:
-            self.api.sendMessage(str(item.userid), "That profile picture is anonymous")
+            self.send_message(str(item.userid), "That profile picture is anonymous")
         url = item.item["profile"]["profile_pic_url"]
         self.uploader.send_media(url, item.item["item_id"], 1, str(item.userid),  username, item.item["profile"]["username"], item.timestamp, cut = False)
         logging.info("Added @{u} to queue".format(u=username))
@@ -567,73 +641,126 @@ class InboxHandler(object):
             uprankdelay = self.delay.get_delay(priority+1)
             if uprankdelay > 150:
                 return
-            self.api.sendMessage(str(item.userid), Language.get_text("long_queue").format(self.queue_total()))
+            self.send_message(str(item.userid), Language.get_text("long_queue").format(self.queue_total()))
 
+    # returns (new items, failed) for the poll scheduler
+    # a failed or throttled inbox request backs the polling off
     def handle_inbox(self):
         print("handle inbox")
         num = 20
         if self.first:
             num = 50
             self.first = False
-        self.api.getv2Inbox(num)
-        with  open(Path("last.json"), "w+") as fp:
-            json.dump(self.api.LastJson, fp)
-        inbox = self.api.LastJson
-
-        if not self.is_inbox_valid(inbox):
-            logging.warning("Invalid inbox.. sleeping 10s")
-            time.sleep(10)
-            return
+        self.poller.acquire()
+        # raw responses are kept in DebugCapture, written out with !dump
+        inbox = self.api.getv2Inbox(num, InboxSync.THREAD_MESSAGE_LIMIT)
+
+        if inbox is None or not self.is_inbox_valid(inbox):
+            logging.warning("Invalid inbox.. backing off")
+            return 0, True
 
-        self.do_inbox_action(inbox)
+        new_items = self.do_inbox_action(inbox)
+        # only appends the queue changes since the last poll
+        self.scheduler.save()
 
         # REVIEW what does this do?
         if inbox["pending_requests_total"] == 0:
-            time.sleep(1)
             self.queue_total(True)
-            x = 0
-            for upl in self.uploader_list:
-                with  open(upl.queue_file, "w+") as fp:
-                    json.dump(upl.queue, fp)
-                x += 1
-            return
+            return new_items, False
 
         print("Now pending..")
-        self.api.get_pending_inbox()
-        inbox = self.api.LastJson
-        self.do_inbox_action(inbox)
+        pending_items, failed = self.handle_pending()
+        return new_items + pending_items, failed
+
+    # pages through the whole pending inbox, approves its threads in batches
+    # and passes their items to the same processing as the normal inbox
+    # stops where the request ceiling is reached, the rest waits for the next poll
+    def handle_pending(self):
+        new_items = 0
+        cursor = None
+        for _ in range(self.PENDING_PAGES):
+            if not self.poller.allow():
+                break
+            inbox = self.api.get_pending_inbox(cursor)
+            if inbox is None:
+                return new_items, True
+
+            threads = inbox["inbox"].get("threads", [])
+            thread_ids = [t["thread_id"] for t in threads]
+            approved = True
+            for x in range(0, len(thread_ids), self.PENDING_BATCH):
+                approved = approved and self.approve_threads(thread_ids[x:x + self.PENDING_BATCH])
+            if not approved:
+                logging.info("Out of requests, pending threads left for the next poll")
+                break
+
+            # message requests, every item of them is handled
+            new_items += self.do_inbox_action(inbox, pending = True)
+            self.scheduler.save()
+            logging.info("Approved {n} pending threads".format(n = len(thread_ids)))
+
+            cursor = inbox["inbox"].get("oldest_cursor")
+            if not inbox["inbox"].get("has_older") or cursor is None:
+                break
+        return new_items, False
+
+    # False when the request ceiling stopped it
+    def approve_threads(self, thread_ids):
+        if not self.poller.allow():
+            return False
+        if self.api.approve_pending_threads(thread_ids) is not None:
+            return True
+        # batch refused, approve one by one
+        for thread_id in thread_ids:
+            if not self.poller.allow():
+                return False
+            if self.api.approve_pending_thread(thread_id) is None:
+                logging.warning("Could not approve thread {t}".format(t = thread_id))
+        return True
+
+    def do_inbox_action(self, inbox, pending = False):
+        # every item that arrived since the last poll, oldest first
+        found = self.inbox_sync.sync(inbox, pending)
+        for thread, new_item in found:
+            try:
+                self.do_item_action(thread, new_item)
+            except Exception as e:
+                logging.error("Item {i} failed: {e}".format(i = new_item.get("item_id"), e = str(e)))
+            # marked even if it failed, a broken item must not be retried on every poll
+            self.inbox_sync.seen(thread, new_item)
+        self.inbox_sync.save()
+        return len(found)
 
-    def do_inbox_action(self, inbox):
-        for i in inbox["inbox"]["threads"]:
-            username = i["users"][0]["username"] if "users" in i and len(i["users"]) > 0 and "username" in i["users"][0] else 0
+    def do_item_action(self, thread, new_item):
+        username = thread["users"][0]["username"] if "users" in thread and len(thread["users"]) > 0 and "username" in thread["users"][0] else 0
 
-            item = InboxItem(i)
-            if item.is_group:
-                continue
-            
-            # reading own message, ignore it
-            if item.author_id != item.userid:
-                continue
+        item = InboxItem(thread, new_item)
+        if item.is_group:
+            return
+        
+        # reading own message, ignore it
+        if item.author_id != item.userid:
+            return
 
-            self.cfg.check_user(username, item.userid)
+        self.cfg.check_user(username, item.userid)
 
-            if item.item_type == "text":
-                self.handle_text(username, item)
+        if item.item_type == "text":
+            self.handle_text(username, item)
 
-            elif item.item_type == "link":
-                self.handle_link(username, item)
+        elif item.item_type == "link":
+            self.handle_link(username, item)
 
-            elif item.item_type == "profile":
-                self.handle_profilepic(username, item)
+        elif item.item_type == "profile":
+            self.handle_profilepic(username, item)
 
-            elif item.item_type == "placeholder":
-                self.handle_placeholder(username, item)
+        elif item.item_type == "placeholder":
+            self.handle_placeholder(username, item)
 
-            elif item.item_type == "story_share":
-                self.handle_story(username, item)
+        elif item.item_type == "story_share":
+            self.handle_story(username, item)
 
-            elif item.item_type == "media_share":
-                self.handle_media_share(username, item)
+        elif item.item_type == "media_share":
+            self.handle_media_share(username, item)
 
 def Login(username, password, admins):
     cfg = Storage()
@@ -646,20 +773,69 @@ def Login(username, password, admins):
         logging.error("Failed to login")
         exit()
 
+    scheduler = Scheduler()
+    cache = MediaCache()
+    prefetcher = Prefetcher(scheduler, cache)
+    transcoder = Transcoder(scheduler, cache)
+    transcoder.start()
+
     uploaders = []
     for x in range(1, 3):
-        queuepath = Path("uploader{0}_queue".format(x))
-
         substorage = APIStorage(x)
         uapi = substorage.load(username, password)
-        test_upl = Uploader(uapi, cfg, delay, x, substorage, queuepath)
-
-        if os.path.exists(queuepath):
-            test_upl.load_queue(json.load(open(queuepath)))
-
-        test_upl.start()
+        test_upl = Uploader(uapi, cfg, delay, x, substorage, scheduler, cache, transcoder)
         uploaders.append(test_upl)
 
+    # load after the uploaders registered, so pinned items find their session
+    journal = QueueJournal(Path("upload_queue"))
+    scheduler.load(journal.load())
+    scheduler.set_journal(journal)
 
-    inbox = InboxHandler(api, cfg, delay, admins, uploaders, [])
-    inbox.run()
\ No newline at end of file
+    # per uploader queue files from before the shared scheduler
+    for x in range(1, 3):
+        legacypath = Path("uploader{0}_queue".format(x))
+        if os.path.exists(legacypath):
+            scheduler.load(json.load(open(legacypath)))
+            scheduler.save()
+            os.remove(legacypath)
+
+    # cuts that were not done before the restart
+    for item in scheduler.queued_items():
+        if item.get("cut") and "media_key" in item and not cache.contains(item["media_key"]) and scheduler.hold(item):
+            transcoder.submit(item)
+
+    inbox = InboxHandler(api, cfg, delay, admins, uploaders, scheduler)
+    inbox.stats_sources.append(inbox.poller)
+    inbox.stats_sources.append(inbox.inbox_sync)
+    inbox.stats_sources.append(cache)
+    inbox.stats_sources.append(transcoder)
+    inbox.stats_sources.append(Connections.stats)
+    inbox.stats_sources.append(Retry.stats)
+    inbox.stats_sources.append(DebugCapture.ring)
+    inbox.stats_sources.append(cfg.stats_buffer)
+    inbox.stats_sources.append(cfg.user_cache)
+    inbox.stats_sources.append(cfg.leaderboards)
+    # kill -USR1 <pid> writes the captured responses to debug/
+    signal.signal(signal.SIGUSR1, lambda signum, frame: DebugCapture.ring.flush_async("signal"))
+    # kill <pid> stops cleanly: uploads in progress finish, queue and statistics are written
+    signal.signal(signal.SIGTERM, lambda signum, frame: inbox.stop())
+
+    prefetcher.start()
+    for upl in uploaders:
+        upl.start()
+
+    try:
+        inbox.run()
+    finally:
+        logging.info("Stopping..")
+        # every step runs, even if an earlier one failed
+        steps = [("prefetcher", prefetcher.stop), ("transcoder", transcoder.stop)]
+        steps += [("uploader #{}".format(upl.number), upl.stop) for upl in uploaders]
+        steps += [("uploader #{} join".format(upl.number), upl.join) for upl in uploaders]
+        steps += [("queue", scheduler.save), ("statistics", cfg.close)]
+        for name, step in steps:
+            try:
+                step()
+            except Exception as e:
+                logging.error("Stopping {n} failed: {e}".format(n = name, e = str(e)))
+        logging.info("Stopped")
\ No newline at end of file
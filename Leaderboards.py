@@ -0,0 +1,73 @@
+import time
+import logging
+import threading
+
+# Materialized top lists for !top, kept in memory per edge collection and role (e.g. download_edges / owner)
+# refreshed every interval seconds from the rollups (one indexed query per board) and updated in between
+# by Storage.count_edges with the same amounts it adds to the rollups
+# a user outside a full board only shows up with the next refresh, totals on the board are exact
+
+class Leaderboards(object):
+    def __init__(self, storage, size = 100, interval = 300):
+        self.storage = storage
+        self.size = size
+        self.interval = interval
+        # held around rollup writes and refreshes, so an amount is never counted twice
+        self.lock = threading.RLock()
+        # boards[(edge, role)] = { username: total }, only boards loaded by refresh()
+        self.boards = {}
+        self.refreshed = 0
+        self.reads = 0
+        self.stopping = threading.Event()
+        self.worker = threading.Thread(target = self.refresh_worker_func, daemon = True)
+
+    def start(self):
+        self.worker.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def refresh(self):
+        for info in self.storage.collection_info_list.values():
+            for role in (info["edge_user"], info["edge_other"]):
+                with self.lock:
+                    rollups = self.storage.get_top_rollups(info, role, self.size)
+                    self.boards[(info["edge_name"], role)] = { r["username"]: r["total"] for r in rollups }
+        self.refreshed = time.time()
+
+    def refresh_worker_func(self):
+        while not self.stopping.is_set():
+            try:
+                self.storage.retry_rollups()
+                self.refresh()
+            except Exception as e:
+                logging.error("Refreshing leaderboards failed: {e}".format(e = str(e)))
+            self.stopping.wait(self.interval)
+
+    # totals[(role, username)] = amount, called with the lock held right after the rollups were written
+    def add(self, edge_name, totals):
+        with self.lock:
+            for (role, username), amount in totals.items():
+                board = self.boards.get((edge_name, role))
+                if board is None:
+                    continue
+                if username in board:
+                    board[username] += amount
+                elif len(board) < self.size:
+                    # the board holds every user of this role, so this one is new
+                    board[username] = amount
+
+    # [{ username, total }] best first, None if the board can not answer (not loaded or too short)
+    def top(self, edge_name, role, top_amount):
+        with self.lock:
+            board = self.boards.get((edge_name, role))
+            if board is None or top_amount > self.size:
+                return None
+            self.reads += 1
+            best = sorted(board.items(), key = lambda b: b[1], reverse = True)[:top_amount]
+        return [{ "username": username, "total": total } for username, total in best]
+
+    def get_stats_text(self):
+        with self.lock:
+            age = time.time() - self.refreshed if self.refreshed > 0 else 0
+            return "Leaderboards: {b} boards, refreshed {a:.0f}s ago, {r} reads".format(b = len(self.boards), a = age, r = self.reads)
@@ -0,0 +1,142 @@
+import os
+import hashlib
+import threading
+import urllib.parse
+from collections import OrderedDict
+from pathlib import Path
+
+# Content addressed media cache under photos/ and videos/, shared by all uploader threads
+# key = media pk + version (hash of the CDN path, without the signed query) + variant (e.g. cut)
+# least recently used files are evicted once the size budget is exceeded, files in use are never evicted
+
+class MediaCache(object):
+    PREFIX = "cache_"
+
+    def __init__(self, budget = 1024 * 1024 * 1024):
+        self.budget = budget
+        self.lock = threading.Lock()
+        # entries[key] = [path, size, references], oldest first
+        self.entries = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load()
+
+    @staticmethod
+    def get_key(item, variant = ""):
+        version = hashlib.md5(urllib.parse.urlsplit(item["url"]).path.encode("utf-8")).hexdigest()[:12]
+        key = "{m}_{v}".format(m = item.get("media_id"), v = version)
+        return key + "_" + variant if variant != "" else key
+
+    @staticmethod
+    def get_path(key, media_type):
+        item_type = "video" if media_type == 2 else "photo"
+        filetype = "mp4" if media_type == 2 else "jpg"
+        return str(Path("./{i}s/{p}{k}.{t}".format(i = item_type, p = MediaCache.PREFIX, k = key, t = filetype)))
+
+    def load(self):
+        # rebuild the index from disk, oldest modified first
+        found = []
+        for folder in ("photos", "videos"):
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if not name.startswith(self.PREFIX):
+                    continue
+                path = str(Path(folder, name))
+                if ".tmp" in name:
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_mtime, name[len(self.PREFIX):].rsplit(".", 1)[0], path, stat.st_size))
+
+        for _, key, path, size in sorted(found):
+            self.entries[key] = [path, size, 0]
+            self.used += size
+        self.evict()
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def acquire(self, key):
+        # returns the cached path and marks it in use, release() it when done
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry[2] += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def release(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] > 0:
+                entry[2] -= 1
+            self.evict()
+
+    def temp_path(self, key, media_type):
+        # keeps the media extension, ffmpeg picks the output format from it
+        path, extension = self.get_path(key, media_type).rsplit(".", 1)
+        return "{p}.tmp{t}.{e}".format(p = path, t = threading.get_ident(), e = extension)
+
+    def commit(self, key, media_type, temp_path):
+        # move a completely written temp file into the cache, returned path is acquired
+        path = self.get_path(key, media_type)
+        size = os.path.getsize(temp_path)
+        with self.lock:
+            os.replace(temp_path, path)
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.used -= entry[1]
+            references = entry[2] if entry is not None else 0
+            self.entries[key] = [path, size, references + 1]
+            self.used += size
+            self.evict()
+        return path
+
+    def store(self, key, media_type, writer):
+        # writer(path) produces the file, e.g. a download or a transcode
+        temp_path = self.temp_path(key, media_type)
+        try:
+            writer(temp_path)
+            return self.commit(key, media_type, temp_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] > 0:
+                return False
+            self.remove_entry(key)
+            return True
+
+    def remove_entry(self, key):
+        path, size, _ = self.entries.pop(key)
+        self.used -= size
+        if os.path.exists(path):
+            os.remove(path)
+
+    # lock must be held
+    def evict(self):
+        if self.used <= self.budget:
+            return
+        for key in list(self.entries.keys()):
+            if self.used <= self.budget:
+                break
+            if self.entries[key][2] == 0:
+                self.remove_entry(key)
+                self.evictions += 1
+
+    def get_stats_text(self):
+        with self.lock:
+            total = self.hits + self.misses
+            rate = (self.hits * 100 // total) if total > 0 else 0
+            return "Media cache: {h} hits / {m} misses ({r}%), {n} files, {u}MB, {e} evicted".format(
+                h = self.hits, m = self.misses, r = rate, n = len(self.entries), u = self.used // (1024 * 1024), e = self.evictions)
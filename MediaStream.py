@@ -0,0 +1,91 @@
+import shutil
+import tempfile
+
+import Connections
+
+# Streams media from the CDN in bounded chunks
+# can be passed straight as a request body (known length + iterable) or spooled to a file when one is needed
+
+class MediaStream(object):
+    CHUNK_SIZE = 64 * 1024
+    # (connect, read) timeout
+    TIMEOUT = (10, 60)
+
+    def __init__(self, url, session = None, chunk_size = CHUNK_SIZE):
+        self.url = url
+        self.chunk_size = chunk_size
+        self.spool = None
+        # optional file object, every chunk sent is also written there (e.g. to fill the media cache)
+        self.tee = None
+        self.consumed = 0
+
+        getter = session if session is not None else Connections.cdn_session()
+        # identity encoding, so Content-Length is the real media size
+        self.response = getter.get(url, stream=True, timeout=self.TIMEOUT, headers={ 'Accept-Encoding': 'identity' })
+        if self.response.status_code != 200:
+            self.response.close()
+            raise Exception("Media download returned {0}".format(self.response.status_code))
+
+        length = self.response.headers.get("Content-Length")
+        if length is not None and length.isdigit():
+            self.length = int(length)
+        else:
+            # unknown size (chunked response), spool to an anonymous temp file to measure it
+            self.spool = tempfile.TemporaryFile()
+            self.length = self.copy_to(self.spool)
+            self.spool.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            if self.tee is not None:
+                self.tee.write(chunk)
+            self.consumed += len(chunk)
+            yield chunk
+
+    def chunks(self):
+        if self.spool is not None:
+            while True:
+                chunk = self.spool.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            return
+
+        for chunk in self.response.iter_content(self.chunk_size):
+            if chunk:
+                yield chunk
+
+    def is_complete(self):
+        return self.consumed == self.length
+
+    def copy_to(self, fp):
+        total = 0
+        for chunk in self.response.iter_content(self.chunk_size):
+            if chunk:
+                fp.write(chunk)
+                total += len(chunk)
+        return total
+
+    def save(self, path):
+        with open(path, "wb") as fp:
+            if self.spool is not None:
+                shutil.copyfileobj(self.spool, fp, self.chunk_size)
+            else:
+                self.copy_to(fp)
+        self.close()
+        return path
+
+    def close(self):
+        self.response.close()
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,22 @@
+import logging
+from MongoStorage import Storage
+
+# One-off database migrations, every step can be run again safely
+# stop the bot first (python Migrate.py, needs MONGODB_URI like LoadBot.py)
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+cfg = Storage()
+
+# users.downloaded_from and requests.requestors (arrays or keyed subdocuments) to edge collections
+# the rollups are recomputed from the edges, which also repairs them
+for info in cfg.collection_info_list.values():
+    migrated = cfg.migrate_edges(info)
+    logging.info("Moved the counters of {n} {c} documents to {e}".format(n = migrated, c = info["name"], e = info["edge_name"]))
+    cfg.rebuild_rollups(info)
+    logging.info("Rebuilt the rollups of {e}".format(e = info["edge_name"]))
+
+cfg.close()
@@ -3,8 +3,14 @@ import datetime
 import Language
 import pymongo
 import requests
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import logging
 
 from Api import InstagramAPI
+from StatsBuffer import StatsBuffer
+from UserCache import UserCache
+from Leaderboards import Leaderboards
 
 # choosing mongoDB as it stores more data compared with postgres
 # https://medium.com/@shivam270295/estimating-average-document-size-in-a-mongodb-collection-953b0788fac0
@@ -20,6 +26,15 @@ class MongoDB(object):
 
 SingleMongoDB = MongoDB()
 
+# counters of the previous layout were keyed subdocuments { username: count }, with "." and a leading "$"
+# stored as their fullwidth forms, only read by the migration now
+
+def unescape_key(key):
+    username = key.replace("\uff0e", ".")
+    if username.startswith("\uff04"):
+        username = "$" + username[1:]
+    return username
+
 # Storage class for Days, Users and Requests data and statistics
 
 class Storage(object):
@@ -27,23 +42,49 @@ class Storage(object):
         self.DEFAULT_PRIORITY = 1
         self.init_db()
         self.init_collection_info()
+        # user documents without the counters of older layouts
+        self.user_projection = { self.collection_info_list["users"]["array_name"]: 0 }
+        self.user_cache = UserCache()
+        # download counts are written behind, see StatsBuffer
+        self.stats_buffer = StatsBuffer(self)
+        self.stats_buffer.start()
+        # rollup increments whose write failed, pending_rollups[edge name][(role, username)] = amount
+        self.pending_rollups = {}
+        # !top without an account reads these
+        self.leaderboards = Leaderboards(self)
+        self.leaderboards.start()
+
+    def close(self):
+        self.stats_buffer.stop()
+        self.leaderboards.stop()
+        self.retry_rollups()
+        if len(self.pending_rollups) > 0:
+            logging.error("Rollups could not be written, run python Migrate.py to rebuild them")
 
     def init_db(self):
         self.db = SingleMongoDB.db
         self.users = self.db["users"]
         self.days = self.db["days"]
         self.requests = self.db["requests"]
+        # totals per user and role of the edge collections: { edge, role, username, total }
+        self.rollups = self.db["rollups"]
 
         # define index for collections, ensure better searching and prevent duplication
         self.users.create_index("username")
         self.days.create_index("date")
         self.requests.create_index("username")
+        self.rollups.create_index([("edge", 1), ("role", 1), ("username", 1)], unique = True)
+        self.rollups.create_index([("edge", 1), ("role", 1), ("total", -1)])
 
     def init_collection_info(self):
         self.collection_info_list = {
             "users": {
                 "name": "users",
                 "array_name": "downloaded_from",
+                # one { downloader, owner, count } document per pair
+                "edge_name": "download_edges",
+                "edge_user": "downloader",
+                "edge_other": "owner",
                 "action_text": "downloads",
                 "aggregate_user": "downloaders for post account",
                 "aggregate_all": "downloaded post accounts",
@@ -53,6 +94,10 @@ class Storage(object):
             "requests": {
                 "name": "requests",
                 "array_name": "requestors",
+                # one { requested, requestor, count } document per pair
+                "edge_name": "request_edges",
+                "edge_user": "requested",
+                "edge_other": "requestor",
                 "action_text": "requests",
                 "aggregate_user": "requested post accounts for requestor",
                 "aggregate_all": "requestors",
@@ -61,6 +106,12 @@ class Storage(object):
             }
         }
 
+        for info in self.collection_info_list.values():
+            edges = self.db[info["edge_name"]]
+            edges.create_index([(info["edge_user"], 1), (info["edge_other"], 1)], unique = True)
+            edges.create_index([(info["edge_user"], 1), ("count", -1)])
+            edges.create_index([(info["edge_other"], 1), ("count", -1)])
+
     # DAY STATS
 
     def get_day_download(self, day = None):
@@ -76,9 +127,9 @@ class Storage(object):
         date_res = self.days.find_one({ "date": date })
         return date_res["counts"] if date_res is not None else 0
 
-    def day_add_download(self):
-        date = datetime.datetime.combine(datetime.date.today(), datetime.time())
-        self.days.update_one({ "date": date }, { "$inc": { "counts": 1 } }, upsert = True)
+    # days[date] = count, from StatsBuffer
+    def write_day_downloads(self, days):
+        self.days.bulk_write([UpdateOne({ "date": date }, { "$inc": { "counts": amount } }, upsert = True) for date, amount in days.items()])
 
     # USER DATA
 
@@ -90,25 +141,33 @@ class Storage(object):
             "userid": userid,
             "username": username,
             "priority": self.DEFAULT_PRIORITY,
-            "latest_item_time": 0,
-            self.collection_info_list["users"]["array_name"]: []
+            "latest_item_time": 0
         }
         user = self.users.insert_one(userData)
         userData["_id"] = user.inserted_id
+        self.user_cache.put(userData)
         return userData
 
+    # write-through, the cache gets the updated document
     def modify_user(self, search_query, modify_query, none_insert = False):
-        user = self.users.find_one_and_update(search_query, modify_query, upsert = none_insert, return_document = pymongo.ReturnDocument.AFTER)
+        user = self.users.find_one_and_update(search_query, modify_query, projection = self.user_projection, upsert = none_insert, return_document = pymongo.ReturnDocument.AFTER)
+        self.user_cache.put(user)
         return user
     
     def internal_get_user(self, userid, create = False, username = ""):
-        user = None
+        has_userid = userid is not None and userid > 0
+        user = self.user_cache.get(userid if has_userid else None, username)
 
-        if userid is not None and userid > 0:
-            user = self.users.find_one({ "userid": userid })
+        # cached under the username but the userid belongs to someone else, ask the database
+        if user is not None and has_userid and user["userid"] not in (userid, ""):
+            user = None
+        cached = user is not None
+
+        if user is None and has_userid:
+            user = self.users.find_one({ "userid": userid }, self.user_projection)
         
         if user is None:
-            user = self.users.find_one({ "username": username })
+            user = self.users.find_one({ "username": username }, self.user_projection)
 
         if user is None and create and username != "":
             return self.create_user(userid, username)
@@ -125,26 +184,29 @@ class Storage(object):
                 need_set = True
             
             if need_set:
-                user = self.users.find_one_and_update({ "_id": user["_id"] }, { "$set": set_query }, return_document = pymongo.ReturnDocument.AFTER)
+                user = self.modify_user({ "_id": user["_id"] }, { "$set": set_query })
+            elif not cached:
+                self.user_cache.put(user)
         return user
 
     def get_user(self, userid):
         userid = self.format_userid(userid)
         return self.internal_get_user(userid)
 
+    # only counted in memory, written by the StatsBuffer worker
     def user_add_download(self, userid, username, downloaded_from):
         userid = self.format_userid(userid)
-        user = self.internal_get_user(userid, create = True, username = username)
-        if user == None:
-            return False
-
-        self.increase_count(self.collection_info_list["users"], "userid", userid, downloaded_from)
-
-        # add day download count
-        self.day_add_download()
-
+        self.stats_buffer.add_download(userid, username, downloaded_from)
         return True
 
+    # downloads[(userid, username)][downloaded_from] = count, from StatsBuffer
+    def write_user_downloads(self, downloads):
+        counts = {}
+        for (userid, username), owners in downloads.items():
+            for downloaded_from, amount in owners.items():
+                counts[(username, downloaded_from)] = counts.get((username, downloaded_from), 0) + amount
+        self.count_edges(self.collection_info_list["users"], counts)
+
     def check_user(self, username, userid = ""):
         userid = self.format_userid(userid)
         return self.internal_get_user(userid, create = True, username = username)
@@ -168,101 +230,143 @@ class Storage(object):
 
     # SHARED PARTS
 
-    def increase_count(self, collection_info, search_key, search_value, count_username):
-        db_name = collection_info["name"]
+    def increase_count(self, collection_info, username, count_username):
+        self.count_edges(collection_info, { (username, count_username): 1 })
+
+    # counts[(username, other username)] = amount
+    # one upserted $inc per edge and per rollup, however many edges a user already has
+    def count_edges(self, collection_info, counts):
+        edge_user = collection_info["edge_user"]
+        edge_other = collection_info["edge_other"]
+        edges = []
+        totals = {}
+        for (username, other), amount in counts.items():
+            edges.append(UpdateOne({ edge_user: username, edge_other: other }, { "$inc": { "count": amount } }, upsert = True))
+            totals[(edge_user, username)] = totals.get((edge_user, username), 0) + amount
+            totals[(edge_other, other)] = totals.get((edge_other, other), 0) + amount
+        if len(edges) == 0:
+            return
+
+        # a failure here raises, the caller retries the whole batch (StatsBuffer) or drops it
+        self.db[collection_info["edge_name"]].bulk_write(edges, ordered = False)
+        # the edges are written, from here on only the rollups are retried
+        self.write_rollups(collection_info["edge_name"], totals)
+
+    # totals[(role, username)] = amount, kept in pending_rollups when the write fails
+    # and written with the next call (or retry_rollups), never raises
+    def write_rollups(self, edge_name, totals):
+        with self.leaderboards.lock:
+            merged = self.pending_rollups.pop(edge_name, {})
+            for key, amount in totals.items():
+                merged[key] = merged.get(key, 0) + amount
+            if len(merged) == 0:
+                return
+            try:
+                self.rollups.bulk_write([UpdateOne({ "edge": edge_name, "role": role, "username": username },
+                                                   { "$inc": { "total": amount } }, upsert = True)
+                                         for (role, username), amount in merged.items()], ordered = False)
+            except Exception as e:
+                logging.error("Writing rollups of {n} failed, retried later: {e}".format(n = edge_name, e = str(e)))
+                self.pending_rollups[edge_name] = merged
+                return
+            self.leaderboards.add(edge_name, merged)
+
+    # called by the leaderboard refresh and on close
+    def retry_rollups(self):
+        with self.leaderboards.lock:
+            edge_names = list(self.pending_rollups)
+        for edge_name in edge_names:
+            self.write_rollups(edge_name, {})
+
+    # embedded counters (array of { username, count } or keyed subdocument) to edges, see Migrate.py
+    # every edge remembers the documents it took counts from (migrated), so a run that stopped between
+    # writing the edges and removing the counters does not add them twice when started again
+    # documents without a username keep their counters, they have no edge to go to
+    def migrate_edges(self, collection_info, batch_size = 500):
         array_name = collection_info["array_name"]
         action_text = collection_info["action_text"]
-        array_username = "{}.username".format(array_name)
-        ref_action_text = "{}.$.{}".format(array_name, action_text)
-
-        # first add in { username, action: 0 } if array does not have username
-        self.db[db_name].update_one({
-            search_key: search_value,
-            array_username: { "$ne": count_username }
-        }, {
-            "$push": { 
-                array_name: { "username": count_username, action_text: 0 }
-            }
-        })
-
-        # then increase by 1
-        self.db[db_name].update_one({
-            search_key: search_value,
-            array_username: count_username
-        }, {
-            "$inc": { ref_action_text: 1 }
-        })
+        collection = self.db[collection_info["name"]]
+        edges = self.db[collection_info["edge_name"]]
+        edge_user = collection_info["edge_user"]
+        edge_other = collection_info["edge_other"]
+        query = { array_name: { "$exists": True }, "username": { "$nin": [ "", None ] } }
+        migrated = 0
+
+        while True:
+            documents = list(collection.find(query, { "username": 1, array_name: 1 }).limit(batch_size))
+            if len(documents) == 0:
+                break
+
+            operations = []
+            for document in documents:
+                counters = document[array_name]
+                if isinstance(counters, dict):
+                    entries = [(unescape_key(k), v) for k, v in counters.items()]
+                else:
+                    entries = [(e["username"], e.get(action_text, 0)) for e in counters]
+                # arrays can hold the same username twice (the old $push race)
+                counts = {}
+                for other, amount in entries:
+                    counts[other] = counts.get(other, 0) + amount
+                for other, amount in counts.items():
+                    if amount > 0:
+                        operations.append(UpdateOne({ edge_user: document["username"], edge_other: other, "migrated": { "$ne": document["_id"] } },
+                                                    { "$inc": { "count": amount }, "$push": { "migrated": document["_id"] } }, upsert = True))
+
+            if len(operations) > 0:
+                try:
+                    edges.bulk_write(operations, ordered = False)
+                except BulkWriteError as e:
+                    # duplicate key = the edge already has the counts of this document
+                    if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                        raise
+            collection.update_many({ "_id": { "$in": [d["_id"] for d in documents] } }, { "$unset": { array_name: "" } })
+            migrated += len(documents)
+
+        left = collection.count_documents({ array_name: { "$exists": True } })
+        if left > 0:
+            logging.warning("{n} {c} documents without a username still hold counters".format(n = left, c = collection_info["name"]))
+        return migrated
+
+    # recomputes the rollups of one edge collection from the edges
+    def rebuild_rollups(self, collection_info):
+        edge_name = collection_info["edge_name"]
+        self.rollups.delete_many({ "edge": edge_name })
+        for role in (collection_info["edge_user"], collection_info["edge_other"]):
+            totals = self.db[edge_name].aggregate([{ "$group": { "_id": "$" + role, "total": { "$sum": "$count" } } }])
+            operations = [UpdateOne({ "edge": edge_name, "role": role, "username": t["_id"] }, { "$set": { "total": t["total"] } }, upsert = True) for t in totals]
+            if len(operations) > 0:
+                self.rollups.bulk_write(operations, ordered = False)
+        self.leaderboards.refresh()
 
     # REQUEST DATA
 
-    def create_request(self, username):
-        requestData = {
-            "username": username,
-            self.collection_info_list["requests"]["array_name"]: []
-        }
-        request = self.requests.insert_one(requestData)
-        requestData["_id"] = request.inserted_id
-        return requestData
-    
-    def internal_get_request(self, username, create = False):
+    def requested_add_request(self, username, requested_by_username):
         if username is None or username == "":
             raise Exception("Username not found!")
 
-        request = self.requests.find_one({ "username": username })
-
-        if request is None and create:
-            return self.create_request(username)
-        
-        return request
-
-    def requested_add_request(self, username, requested_by_username):
-        self.internal_get_request(username, create = True)
-
-        self.increase_count(self.collection_info_list["requests"], "username", username, requested_by_username)
+        self.increase_count(self.collection_info_list["requests"], username, requested_by_username)
 
     # STATS FUNCTION
 
-    def aggregate_query(self, collection_name, array_name, count_name, username, top_amount):
-        # pipeline for top 5 most post/requested account: unwind, group, sort and limit
-        # pipeline for top 5 most downloaders/requestors for specific post/requested account: unwind, match, sort, limit and group
-        array_username = "{}.username".format(array_name)
-        full_count_name = "{}.{}".format(array_name, count_name)
-
-        ref_array_name = "$" + array_name
-        aref_rray_username = "$" + array_username
-        ref_full_count_name = "$" + full_count_name
+    # the stats read the edges and rollups through their indexes, no document is scanned
 
-        has_username = username != "" and username is not None
-
-        aggregate_pipe = [ { "$unwind": { "path": ref_array_name } } ]
-        group_pipe = {
-            "_id": aref_rray_username,
-            "total": { "$sum": ref_full_count_name }
-        }
-        sort_pipe = {}
+    def get_rollup_total(self, collection_info, role, username):
+        rollup = self.rollups.find_one({ "edge": collection_info["edge_name"], "role": role, "username": username })
+        return rollup["total"] if rollup is not None else 0
 
-        if has_username:
-            group_pipe[array_name] = {
-                "$push": {
-                    "username": "$username", 
-                    count_name: ref_full_count_name
-                }
-            }
-            sort_pipe[full_count_name] = -1
-            aggregate_pipe.append({ "$match": { array_username: username } })
-        else:
-            sort_pipe["total"] = -1
-            aggregate_pipe.append({ "$group": group_pipe })
-        
-        aggregate_pipe.append({ "$sort": sort_pipe })
+    def get_top_rollups(self, collection_info, role, top_amount):
+        return self.rollups.find({ "edge": collection_info["edge_name"], "role": role }).sort("total", -1).limit(top_amount)
 
-        aggregate_pipe.append({ "$limit": top_amount })
+    # from the leaderboard when it can answer, the rollups otherwise
+    def get_top_totals(self, collection_info, role, top_amount):
+        top = self.leaderboards.top(collection_info["edge_name"], role, top_amount)
+        if top is None:
+            top = self.get_top_rollups(collection_info, role, top_amount)
+        return top
 
-        # TODO: fix count, as previous limit pipeline removed rest
-        if has_username:
-            aggregate_pipe.append({ "$group": group_pipe })
-        
-        return self.db[collection_name].aggregate(aggregate_pipe)
+    def get_top_edges(self, collection_info, role, username, top_amount):
+        return self.db[collection_info["edge_name"]].find({ role: username }).sort("count", -1).limit(top_amount)
 
     def format_text(self, array, username_key, total_key, action_text):
         index = 1
@@ -281,64 +385,39 @@ class Storage(object):
             return Language.get_text("admin.no_spec_data").format(a = action_text, u = username)
         return output + extra_info
 
+    # top post owners / requestors, or the top downloaders / requested accounts of one of them
     def get_aggregated_account_info(self, collection_info, username, top_amount):
         has_username = username != "" and username is not None
-        array_name = collection_info["array_name"]
         action_text = collection_info["action_text"]
-
-        results = self.aggregate_query(collection_info["name"], array_name, action_text, username, top_amount)
+        edge_user = collection_info["edge_user"]
+        edge_other = collection_info["edge_other"]
         output = "Top {c} ".format(c = top_amount)
-        extra_info = ""
 
         if has_username:
-            total = 0
-            for relation_user in results:
-                total = relation_user["total"]
-                extra_info += self.format_text(relation_user[array_name], "username", action_text, action_text)
+            total = self.get_rollup_total(collection_info, edge_other, username)
+            extra_info = self.format_text(self.get_top_edges(collection_info, edge_other, username, top_amount), edge_user, "count", action_text)
             output += "{o} @{u} (total of {t} {a})".format(o = collection_info["aggregate_user"], u = username, t = total, a = action_text)
         else:
             output += collection_info["aggregate_all"] 
-            extra_info += self.format_text(results, "_id", "total", action_text)
+            extra_info = self.format_text(self.get_top_totals(collection_info, edge_other, top_amount), "username", "total", action_text)
         
         return self.format_output(output, extra_info, username, action_text)
 
+    # top downloaders / requested accounts, or the top post owners / requestors of one of them
     def get_query_account_info(self, collection_info, username, top_amount):
         has_username = username != "" and username is not None
-        array_name = collection_info["array_name"]
         action_text = collection_info["action_text"]
-        ref_full_count_name = "${}.{}".format(array_name, action_text)
-
-        aggregate_pipe = []
+        edge_user = collection_info["edge_user"]
+        edge_other = collection_info["edge_other"]
         output = "Top {c} ".format(c = top_amount)
-        results = None
-        key = ""
 
-        # add filter username pipeline FIRST if username exist
-        if has_username:
-            aggregate_pipe.append( { "$match": { "username": username } } )
-        
-        aggregate_pipe += [
-            { "$addFields": { "total": { "$sum": ref_full_count_name } } },
-            { "$sort": { "total": -1 } },
-            { "$limit": top_amount }
-        ]
-        
         if has_username:
-            key = action_text
+            total = self.get_rollup_total(collection_info, edge_user, username)
+            extra_info = self.format_text(self.get_top_edges(collection_info, edge_user, username, top_amount), edge_other, "count", action_text)
+            output += "{o} @{u} (total of {t} {a})".format(o = collection_info["query_user"], u = username, t = total, a = action_text)
         else:
-            key = "total"
             output += collection_info["query_all"]
-
-        results = self.db[collection_info["name"]].aggregate(aggregate_pipe)
-        
-        if has_username:
-            total = 0
-            for result in results:
-                total = result["total"]
-                results = sorted(result[array_name], key = lambda dl: dl[action_text], reverse = True)[:top_amount]
-            output += "{o} @{u} (total of {t} downloads)".format(o = collection_info["query_user"], u = username, t = total)
-        
-        extra_info = self.format_text(results, "username", key, action_text)
+            extra_info = self.format_text(self.get_top_totals(collection_info, edge_user, top_amount), "username", "total", action_text)
 
         return self.format_output(output, extra_info, username, action_text)
     
@@ -402,13 +481,6 @@ class APIStorage(object):
             instaAPI.isLoggedIn = True
             instaAPI.token = output_data["token"]
             self.to_cookies(output_data['cookies'], instaAPI.s.cookies)
-            instaAPI.s.headers.update({ 'Cookie2': '$Version=1',
-                                        'Accept-Language': 'en-US',
-                                        'Accept-Encoding': 'gzip, deflate',
-                                        'Accept': '*/*',
-                                        'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-                                        'Connection': 'close',
-                                        'User-Agent': instaAPI.USER_AGENT })
         
         return instaAPI
 
@@ -0,0 +1,59 @@
+# Lazy paging over the max_id based feeds (followers, followings, user feed, liked media)
+# only the current page is held, items are yielded as the pages arrive
+# next_max_id is the cursor to resume from, e.g. after a failed request or in a later run:
+#
+#   followers = api.iterFollowers(user_id, limit = 1000)
+#   for user in followers:
+#       ...
+#   api.iterFollowers(user_id, followers.next_max_id)
+#
+# when the limit ends a page early, next_max_id stays at that page, so resuming repeats its items instead of skipping them
+
+class Paginator(object):
+    # fetch(max_id) returns the page json or None, has_more(page) tells if another page follows
+    def __init__(self, fetch, items_key, has_more, next_max_id = '', limit = None, max_pages = None):
+        self.fetch = fetch
+        self.items_key = items_key
+        self.has_more = has_more
+        self.next_max_id = next_max_id
+        self.limit = limit
+        self.max_pages = max_pages
+        self.count = 0
+        self.page_count = 0
+        # cursor the current page was fetched with
+        self.page_max_id = next_max_id
+        self.done = False
+        # the last request failed, can be resumed from next_max_id
+        self.failed = False
+
+    def is_full(self):
+        return self.limit is not None and self.count >= self.limit
+
+    def pages(self):
+        while not self.done and not self.is_full():
+            if self.max_pages is not None and self.page_count >= self.max_pages:
+                return
+            self.page_max_id = self.next_max_id
+            page = self.fetch(self.page_max_id)
+            if page is None:
+                self.failed = True
+                return
+            self.failed = False
+            self.page_count += 1
+            next_max_id = page.get("next_max_id")
+            if not self.has_more(page) or not next_max_id:
+                self.done = True
+            else:
+                self.next_max_id = next_max_id
+            yield page
+
+    def __iter__(self):
+        for page in self.pages():
+            for item in page.get(self.items_key, []):
+                if self.is_full():
+                    # page cut short, resume from its own cursor
+                    self.next_max_id = self.page_max_id
+                    self.done = False
+                    return
+                self.count += 1
+                yield item
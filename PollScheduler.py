@@ -0,0 +1,90 @@
+import time
+import threading
+from collections import deque
+
+# Adaptive inbox polling interval
+# new items halve the interval (down to minimum), idle polls stretch it (up to idle),
+# failed / throttled polls double it (up to maximum)
+# a hard ceiling of requests per minute for the inbox account: every request of the account takes a slot
+# with acquire() (waits) or allow() (gives up), the next poll also waits for a free slot
+# arrival rate is an exponentially weighted moving average of new items per second
+
+class PollScheduler(object):
+    def __init__(self, minimum = 2, start = 15, idle = 30, maximum = 300, ceiling = 30, alpha = 0.3):
+        self.minimum = minimum
+        self.idle = idle
+        self.maximum = maximum
+        # requests per account and minute
+        self.ceiling = ceiling
+        self.alpha = alpha
+        self.interval = float(start)
+        self.rate = 0.0
+        self.throttles = 0
+        # requests refused by allow()
+        self.denied = 0
+        self.last = time.time()
+        # timestamps of the requests in the last minute
+        self.requests = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def record(self, new_items, failed = False):
+        with self.lock:
+            now = time.time()
+            elapsed = max(now - self.last, 0.001)
+            self.last = now
+            self.rate = self.alpha * (new_items / elapsed) + (1 - self.alpha) * self.rate
+
+            if failed:
+                self.throttles += 1
+                self.interval = min(self.maximum, max(self.interval * 2, self.idle))
+            elif new_items > 0:
+                self.interval = max(self.minimum, self.interval / 2)
+            else:
+                self.interval = min(self.idle, max(self.interval * 1.5, self.minimum))
+
+    def slot_wait(self):
+        # seconds until a request is allowed, lock must be held
+        now = time.time()
+        while self.requests and self.requests[0] <= now - 60:
+            self.requests.popleft()
+        if len(self.requests) < self.ceiling:
+            return 0
+        return self.requests[len(self.requests) - self.ceiling] + 60 - now
+
+    # takes a request slot if one is free
+    def allow(self):
+        with self.lock:
+            if self.slot_wait() > 0:
+                self.denied += 1
+                return False
+            self.requests.append(time.time())
+            return True
+
+    # waits for a request slot
+    def acquire(self):
+        while True:
+            with self.lock:
+                wait = self.slot_wait()
+                if wait <= 0:
+                    self.requests.append(time.time())
+                    return
+            time.sleep(wait)
+
+    def next_wait(self):
+        with self.lock:
+            return max(self.interval, self.slot_wait())
+
+    def wait(self):
+        # returns early on wake(), e.g. when stopping
+        self.wakeup.wait(self.next_wait())
+        self.wakeup.clear()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def get_stats_text(self):
+        wait = self.next_wait()
+        with self.lock:
+            return "Inbox polling: next in {w:.1f}s (interval {i:.1f}s), {r:.1f} items/min, {n}/{c} requests last minute, {d} refused, {t} failed polls".format(
+                w = wait, i = self.interval, r = self.rate * 60, n = len(self.requests), c = self.ceiling, d = self.denied, t = self.throttles)
@@ -0,0 +1,101 @@
+import time
+import logging
+import threading
+
+from MediaStream import MediaStream
+from MediaCache import MediaCache
+
+# Downloads the next queued items into the media cache while the uploaders sit in their pacing sleep
+# bounded by amount of items (depth) and bytes prefetched but not uploaded yet (budget)
+# items that got removed, uploaded or pushed out of the top by a priority change stop counting against the budget
+
+class Prefetcher(object):
+    def __init__(self, scheduler, cache, depth = 6, budget = 200 * 1024 * 1024):
+        self.scheduler = scheduler
+        self.cache = cache
+        self.depth = depth
+        self.budget = budget
+        self.lock = threading.Lock()
+        # fetched[queue_id] = (cache key, size)
+        self.fetched = {}
+        self.used = 0
+        self.running = False
+        self.worker = threading.Thread(target=self.prefetch_worker_func)
+
+    def start(self):
+        self.running = True
+        self.worker.start()
+
+    def stop(self):
+        self.running = False
+
+    def forget(self, queue_id, discard = False):
+        with self.lock:
+            if queue_id not in self.fetched:
+                return
+            key, size = self.fetched.pop(queue_id)
+            self.used -= size
+        if discard:
+            self.cache.discard(key)
+
+    def is_cached(self, item):
+        if self.cache.contains(MediaCache.get_key(item)):
+            return True
+        return "cut" in item and item["cut"] and self.cache.contains(MediaCache.get_key(item, "cut"))
+
+    def fetch(self, item, lower):
+        # lower: already fetched items further down the queue, dropped (last first) if the budget is short
+        key = MediaCache.get_key(item)
+        stream = MediaStream(item["url"])
+        try:
+            with self.lock:
+                free = self.budget - self.used
+            while len(stream) > free and len(lower) > 0:
+                self.forget(lower.pop(), True)
+                with self.lock:
+                    free = self.budget - self.used
+            if len(stream) > free:
+                return False
+            self.cache.store(key, item["media_type"], stream.save)
+            self.cache.release(key)
+        finally:
+            stream.close()
+
+        with self.lock:
+            self.fetched[item["queue_id"]] = (key, len(stream))
+            self.used += len(stream)
+        return True
+
+    def prefetch_once(self):
+        upcoming = self.scheduler.upcoming(self.depth)
+        keep = set(i["queue_id"] for i in upcoming)
+
+        with self.lock:
+            stale = [q for q in self.fetched if q not in keep]
+        for queue_id in stale:
+            # left in the cache, other requests for the same media can still use it
+            self.forget(queue_id)
+
+        for index, item in enumerate(upcoming):
+            if not self.running:
+                return
+            with self.lock:
+                if item["queue_id"] in self.fetched:
+                    continue
+                lower = [i["queue_id"] for i in upcoming[index + 1:] if i["queue_id"] in self.fetched]
+            if self.is_cached(item):
+                continue
+            try:
+                if not self.fetch(item, lower):
+                    # out of budget, the rest is further down the queue anyway
+                    return
+            except Exception as e:
+                logging.warning("Prefetch of @{u} failed: {e}".format(u = item["username"], e = str(e)))
+
+    def prefetch_worker_func(self):
+        while self.running:
+            try:
+                self.prefetch_once()
+            except Exception as e:
+                logging.error("Prefetcher crashed: {0}".format(str(e)))
+            time.sleep(1)
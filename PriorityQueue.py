@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import threading
+import uuid
+
+# Heap backed priority queue for upload items
+# highest priority first, FIFO within the same priority level
+# removed / re-prioritized entries are marked invalid and skipped lazily on pop
+
+class PriorityQueue(object):
+    def __init__(self):
+        self.heap = []
+        # entries[queue_id] = [-priority, sequence, push number, item]
+        # push number is unique, so an item pushed back with its old sequence never ties with its own stale entry
+        self.entries = {}
+        self.counter = itertools.count()
+        self.pushes = itertools.count()
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def extract_priority(item):
+        if "priority" in item:
+            return int(item["priority"])
+        return 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __contains__(self, queue_id):
+        return queue_id in self.entries
+
+    def push(self, item, sequence = None):
+        with self.lock:
+            if "queue_id" not in item:
+                item["queue_id"] = uuid.uuid4().hex
+            queue_id = item["queue_id"]
+            if queue_id in self.entries:
+                self.remove(queue_id)
+            if sequence is None:
+                sequence = next(self.counter)
+            entry = [-self.extract_priority(item), sequence, next(self.pushes), item]
+            self.entries[queue_id] = entry
+            heapq.heappush(self.heap, entry)
+            return queue_id
+
+    def clean_top(self):
+        # drop invalidated entries sitting at the top of the heap
+        while self.heap and self.heap[0][3] is None:
+            heapq.heappop(self.heap)
+
+    def peek(self):
+        with self.lock:
+            self.clean_top()
+            return self.heap[0][3] if self.heap else None
+
+    def peek_entry(self):
+        # (-priority, sequence) of the top item, used to compare between queues
+        with self.lock:
+            self.clean_top()
+            return (self.heap[0][0], self.heap[0][1]) if self.heap else None
+
+    def pop(self):
+        with self.lock:
+            self.clean_top()
+            if not self.heap:
+                return None
+            entry = heapq.heappop(self.heap)
+            del self.entries[entry[3]["queue_id"]]
+            return entry[3]
+
+    def get(self, queue_id):
+        with self.lock:
+            entry = self.entries.get(queue_id)
+            return entry[3] if entry is not None else None
+
+    def get_sequence(self, queue_id):
+        with self.lock:
+            entry = self.entries.get(queue_id)
+            return entry[1] if entry is not None else None
+
+    def remove(self, queue_id):
+        with self.lock:
+            entry = self.entries.pop(queue_id, None)
+            if entry is None:
+                return None
+            item = entry[3]
+            entry[3] = None
+            self.compact()
+            return item
+
+    def reprioritize(self, queue_id, priority):
+        with self.lock:
+            entry = self.entries.get(queue_id)
+            if entry is None:
+                return False
+            item = entry[3]
+            if self.extract_priority(item) == int(priority):
+                item["priority"] = priority
+                return True
+            item["priority"] = priority
+            # keep the original sequence so FIFO order is preserved within the new level
+            self.remove(queue_id)
+            self.push(item, entry[1])
+            return True
+
+    def compact(self):
+        # rebuild once invalidated entries outnumber the live ones, keeps heap size bounded
+        if len(self.heap) > 64 and len(self.heap) > 2 * len(self.entries):
+            self.heap = [e for e in self.heap if e[3] is not None]
+            heapq.heapify(self.heap)
+
+    def smallest(self, amount):
+        # the next `amount` entries in pop order, without popping them
+        # walks the heap from the top (children are never smaller than their parent), so only about
+        # amount * log(amount) entries are looked at instead of the whole queue
+        with self.lock:
+            result = []
+            frontier = [(self.heap[0][:3], 0)] if self.heap else []
+            while frontier and len(result) < amount:
+                _, index = heapq.heappop(frontier)
+                entry = self.heap[index]
+                if entry[3] is not None:
+                    result.append(entry)
+                for child in (2 * index + 1, 2 * index + 2):
+                    if child < len(self.heap):
+                        heapq.heappush(frontier, (self.heap[child][:3], child))
+            return result
+
+    def to_list(self):
+        # snapshot in pop order, used for persistence and reports
+        with self.lock:
+            return [e[3] for e in sorted(self.entries.values())]
+
+    def clear(self):
+        with self.lock:
+            self.heap = []
+            self.entries = {}
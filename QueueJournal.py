@@ -0,0 +1,96 @@
+import os
+import json
+import logging
+
+# Append only journal for the upload queue
+# snapshot file: full queue as a json list (same format as the old queue file)
+# journal file: one json event per line, {"op": "add", "item": {...}}, {"op": "remove", "queue_id": "..."}
+# or {"op": "priority", "queue_id": "...", "priority": n}
+# events are buffered in memory and appended on flush, so a flush costs the amount of changes, not the queue size
+# replay is keyed by queue_id, a crash between snapshot replace and journal truncate replays safely
+
+class QueueJournal(object):
+    def __init__(self, path, compact_every = 5000):
+        self.snapshot_path = str(path)
+        self.journal_path = str(path) + ".journal"
+        self.compact_every = compact_every
+        self.pending = []
+        self.journal_lines = 0
+        self.broken = False
+
+    def load(self):
+        items = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as fp:
+                for item in json.load(fp):
+                    items[item.get("queue_id", id(item))] = item
+
+        self.journal_lines = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as fp:
+                for line in fp:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # torn write from a crash, everything before it is intact
+                        logging.warning("Queue journal has a broken line, ignoring the rest")
+                        # appending after a torn line would break the next event too, compact on first flush
+                        self.broken = True
+                        break
+                    self.apply(items, event)
+                    self.journal_lines += 1
+
+        return list(items.values())
+
+    @staticmethod
+    def apply(items, event):
+        if event["op"] == "add":
+            items[event["item"]["queue_id"]] = event["item"]
+        elif event["op"] == "remove":
+            items.pop(event["queue_id"], None)
+        elif event["op"] == "priority" and event["queue_id"] in items:
+            items[event["queue_id"]]["priority"] = event["priority"]
+
+    def record(self, event):
+        self.pending.append(json.dumps(event))
+
+    def record_add(self, item):
+        self.record({ "op": "add", "item": item })
+
+    def record_remove(self, queue_id):
+        self.record({ "op": "remove", "queue_id": queue_id })
+
+    def record_priority(self, queue_id, priority):
+        self.record({ "op": "priority", "queue_id": queue_id, "priority": priority })
+
+    # must be called with the scheduler locked, snapshot() has to match the recorded events
+    def flush(self, snapshot):
+        if self.broken or self.journal_lines + len(self.pending) >= self.compact_every:
+            self.compact(snapshot())
+            return
+
+        if len(self.pending) == 0:
+            return
+
+        with open(self.journal_path, "a") as fp:
+            fp.write("\n".join(self.pending) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.journal_lines += len(self.pending)
+        self.pending = []
+
+    def compact(self, items):
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "w") as fp:
+            json.dump(items, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+        # snapshot now contains everything, start a new journal
+        with open(self.journal_path, "w") as fp:
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.journal_lines = 0
+        self.pending = []
+        self.broken = False
@@ -0,0 +1,190 @@
+import re
+import time
+import random
+import asyncio
+import threading
+
+# Retry policies for the API calls
+# a call is classified as done, retryable (network error, 5xx, 429, or 202 while polling) or fatal (other 4xx)
+# retryable calls wait with exponential backoff and full jitter, bounded by attempts, a deadline
+# and a per-endpoint budget of retries per minute, so an outage does not turn into a retry storm
+# the policies below are templates by prefix, every endpoint (path without ids) gets its own copy,
+# so one noisy endpoint can not use up the budget of the others
+# time spent waiting is counted per endpoint and shown in !stats
+
+DONE = "done"
+RETRY = "retry"
+FATAL = "fatal"
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class RetryStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # endpoints[name] = [retries, seconds waited, gave up]
+        self.endpoints = {}
+
+    def count(self, name, index, amount = 1):
+        with self.lock:
+            if name not in self.endpoints:
+                self.endpoints[name] = [0, 0.0, 0]
+            self.endpoints[name][index] += amount
+
+    def add_wait(self, name, seconds):
+        self.count(name, 0)
+        self.count(name, 1, seconds)
+
+    def add_give_up(self, name):
+        self.count(name, 2)
+
+    def get_stats_text(self):
+        with self.lock:
+            if len(self.endpoints) == 0:
+                return "Retries: none"
+            parts = ["{n} {r}x/{w:.0f}s/{g} failed".format(n = n, r = e[0], w = e[1], g = e[2]) for n, e in sorted(self.endpoints.items())]
+            return "Retries: " + ", ".join(parts)
+
+stats = RetryStats()
+
+class RetryPolicy(object):
+    def __init__(self, name, attempts = 5, base = 2, cap = 60, deadline = 300, budget = 20, pending = ()):
+        self.name = name
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        # retries allowed per minute over all callers of this endpoint
+        self.budget = budget
+        # statuses meaning "not ready yet, ask again" (e.g. 202 while configuring a video)
+        self.pending = pending
+        self.tokens = float(budget)
+        self.refilled = time.time()
+        self.lock = threading.Lock()
+
+    # same settings, own budget and stats line
+    def for_endpoint(self, key):
+        return RetryPolicy(key, self.attempts, self.base, self.cap, self.deadline, self.budget, self.pending)
+
+    def classify(self, status):
+        if status == 200:
+            return DONE
+        if status in RETRY_STATUSES or status in self.pending:
+            return RETRY
+        return FATAL
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * (2 ** (attempt - 1))))
+
+    def take_budget(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(float(self.budget), self.tokens + (now - self.refilled) * self.budget / 60.0)
+            self.refilled = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def next_delay(self, attempt, start):
+        # None when the call has to give up
+        delay = self.backoff(attempt)
+        if attempt >= self.attempts or time.time() - start + delay > self.deadline or not self.take_budget():
+            stats.add_give_up(self.name)
+            return None
+        stats.add_wait(self.name, delay)
+        return delay
+
+    # func() returns a response with a status_code (or status), exceptions in `errors` are retried
+    # when giving up the last response is returned / the last exception raised
+    def run(self, func, errors = (OSError,)):
+        start = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = func()
+            except errors:
+                delay = self.next_delay(attempt, start)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            if self.classify(get_status(response)) != RETRY:
+                return response
+            delay = self.next_delay(attempt, start)
+            if delay is None:
+                return response
+            time.sleep(delay)
+
+    async def run_async(self, func, errors = (OSError, asyncio.TimeoutError)):
+        start = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await func()
+            except errors:
+                delay = self.next_delay(attempt, start)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            if self.classify(get_status(response)) != RETRY:
+                return response
+            delay = self.next_delay(attempt, start)
+            if delay is None:
+                return response
+            await asyncio.sleep(delay)
+
+def get_status(response):
+    if isinstance(response, tuple):
+        return response[0]
+    return response.status_code
+
+# polled again anyway, do not stall the inbox loop
+inbox = RetryPolicy("inbox", attempts = 3, cap = 10, deadline = 30)
+
+# endpoint prefix -> policy, the longest matching prefix wins
+policies = {
+    "": RetryPolicy("api"),
+    "direct_v2/inbox": inbox,
+    "direct_v2/pending_inbox": inbox,
+    "direct_v2/threads/broadcast/text": RetryPolicy("message", attempts = 4, cap = 30, deadline = 120),
+    "rupload": RetryPolicy("rupload", attempts = 4, cap = 20, deadline = 90),
+    # 202 = video still transcoding on their side
+    "direct_v2/threads/broadcast/configure": RetryPolicy("configure", attempts = 12, base = 2, cap = 10, deadline = 90, budget = 60, pending = (202,)),
+}
+
+# path segments that are ids (thread, user, media, upload ids), "direct_v2" stays
+ID_SEGMENT = re.compile(r"^[0-9a-fA-F_:\-]*[0-9][0-9a-fA-F_:\-]*$")
+# segments after these are names (users/<username>/usernameinfo), except the listed actions
+NAMED_PARENTS = ("users", "tags")
+NAMED_ACTIONS = ("search",)
+# more distinct endpoints share the template budget
+MAX_ENDPOINTS = 100
+
+def get_key(endpoint):
+    parts = []
+    for part in endpoint.split("?")[0].strip("/").split("/"):
+        if ID_SEGMENT.match(part) or (len(parts) > 0 and parts[-1] in NAMED_PARENTS and part not in NAMED_ACTIONS):
+            part = "*"
+        parts.append(part)
+    return "/".join(parts)
+
+# endpoint_policies[key] = RetryPolicy
+endpoint_policies = {}
+endpoint_lock = threading.Lock()
+
+def get_policy(endpoint):
+    key = get_key(endpoint)
+    with endpoint_lock:
+        if key in endpoint_policies:
+            return endpoint_policies[key]
+        best = ""
+        for prefix in policies:
+            if endpoint.startswith(prefix) and len(prefix) > len(best):
+                best = prefix
+        if len(endpoint_policies) >= MAX_ENDPOINTS:
+            return policies[best]
+        endpoint_policies[key] = policies[best].for_endpoint(key)
+        return endpoint_policies[key]
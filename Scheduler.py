@@ -0,0 +1,320 @@
+import heapq
+import itertools
+import threading
+
+from PriorityQueue import PriorityQueue
+
+# Shared upload scheduler, every Uploader pulls its next job from here
+# shared queue: any idle uploader can take the item
+# pinned queue: item must go out through one specific session (carousel posts)
+
+class Scheduler(object):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.shared = PriorityQueue()
+        # pinned[number] = PriorityQueue() for uploader #number
+        self.pinned = {}
+        # in_flight[number] = [(item, sequence), ...] currently uploaded by uploader #number
+        # more than one when queued requests for the same media are delivered with one upload
+        self.in_flight = {}
+        # queue_count[userid] = remaining_left, includes in flight items
+        self.queue_count = {}
+        # post_index[(username, media_id)] / item_index[item_id] = amount queued, includes in flight items
+        self.post_index = {}
+        self.item_index = {}
+        # user_count[username] = amount queued, includes in flight items
+        # user_items[username][queue_id] = item, only items still waiting (removable)
+        self.user_count = {}
+        self.user_items = {}
+        # media_items[media_key][queue_id] = item, waiting items of the shared queue only
+        # (pinned items keep their order and session)
+        self.media_items = {}
+        # held[queue_id] = (item, sequence), counted and saved but not claimable yet (e.g. waiting for a cut)
+        self.held = {}
+        # one sequence for all queues so FIFO holds across shared and pinned items
+        self.sequence = itertools.count()
+        # QueueJournal, set after the initial load so replayed items are not recorded again
+        self.journal = None
+
+    def register(self, number):
+        with self.lock:
+            if number not in self.pinned:
+                self.pinned[number] = PriorityQueue()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.shared) + sum(len(q) for q in self.pinned.values()) + sum(len(f) for f in self.in_flight.values()) + len(self.held)
+
+    def get_queue(self, item):
+        pinned = item.get("pinned")
+        if pinned is not None and pinned in self.pinned:
+            return self.pinned[pinned]
+        return self.shared
+
+    def add(self, item, pinned = None, sequence = None, hold = False):
+        with self.lock:
+            if pinned is not None:
+                item["pinned"] = pinned
+            elif item.get("pinned") not in self.pinned:
+                # pinned session no longer exists, let anyone take it
+                item.pop("pinned", None)
+            if sequence is None:
+                sequence = next(self.sequence)
+            self.get_queue(item).push(item, sequence)
+            self.index_item(item)
+            if self.journal is not None:
+                self.journal.record_add(item)
+            if hold:
+                self.hold(item)
+
+    def hold(self, item):
+        # take a waiting item out of the queues until ready(), it keeps its sequence
+        with self.lock:
+            queue = self.get_queue(item)
+            sequence = queue.get_sequence(item["queue_id"])
+            if sequence is None:
+                return False
+            queue.remove(item["queue_id"])
+            self.unbucket_item(item)
+            self.held[item["queue_id"]] = (item, sequence)
+            self.add_bucket(self.user_items, item["username"], item)
+            return True
+
+    def ready(self, item):
+        with self.lock:
+            if item["queue_id"] not in self.held:
+                # removed while it was held
+                return False
+            item, sequence = self.held.pop(item["queue_id"])
+            self.get_queue(item).push(item, sequence)
+            self.bucket_item(item)
+            return True
+
+    def load(self, queue):
+        # queue file is saved in pop order, adding in the same order keeps FIFO
+        for item in queue:
+            self.add(item)
+
+    @staticmethod
+    def increase_index(index, key):
+        if key not in index:
+            index[key] = 0
+        index[key] += 1
+
+    @staticmethod
+    def decrease_index(index, key):
+        index[key] -= 1
+        if index[key] <= 0:
+            del index[key]
+
+    @staticmethod
+    def post_key(item):
+        return (item["username"], item.get("media_id"))
+
+    # indexes are only touched while holding the lock, on add and on final removal
+    def index_item(self, item):
+        self.increase_index(self.queue_count, str(item["userid"]))
+        self.increase_index(self.post_index, self.post_key(item))
+        self.increase_index(self.item_index, item["item_id"])
+        self.increase_index(self.user_count, item["username"])
+        self.bucket_item(item)
+
+    def unindex_item(self, item):
+        self.decrease_index(self.queue_count, str(item["userid"]))
+        self.decrease_index(self.post_index, self.post_key(item))
+        self.decrease_index(self.item_index, item["item_id"])
+        self.decrease_index(self.user_count, item["username"])
+        self.unbucket_item(item)
+        if self.journal is not None:
+            self.journal.record_remove(item["queue_id"])
+
+    @staticmethod
+    def add_bucket(buckets, key, item):
+        if key not in buckets:
+            buckets[key] = {}
+        buckets[key][item["queue_id"]] = item
+
+    @staticmethod
+    def remove_bucket(buckets, key, item):
+        bucket = buckets.get(key)
+        if bucket is None:
+            return
+        bucket.pop(item["queue_id"], None)
+        if len(bucket) == 0:
+            del buckets[key]
+
+    # buckets only hold waiting items, claimed ones are taken out until released
+    def bucket_item(self, item):
+        self.add_bucket(self.user_items, item["username"], item)
+        if item.get("media_key") is not None and "pinned" not in item:
+            self.add_bucket(self.media_items, item["media_key"], item)
+
+    def unbucket_item(self, item):
+        self.remove_bucket(self.user_items, item["username"], item)
+        if item.get("media_key") is not None:
+            self.remove_bucket(self.media_items, item["media_key"], item)
+
+    def remaining(self, userid):
+        with self.lock:
+            return self.queue_count.get(str(userid), 0)
+
+    def select_queue(self, number):
+        # pick whichever of the shared and the uploader's pinned queue has the best head
+        best = None
+        best_entry = None
+        for queue in (self.shared, self.pinned.get(number)):
+            if queue is None:
+                continue
+            entry = queue.peek_entry()
+            if entry is not None and (best_entry is None or entry < best_entry):
+                best = queue
+                best_entry = entry
+        return best, best_entry
+
+    def peek(self, number):
+        with self.lock:
+            queue, _ = self.select_queue(number)
+            return queue.peek() if queue is not None else None
+
+    def claim(self, number):
+        with self.lock:
+            if number in self.in_flight:
+                return self.in_flight[number][0][0]
+            queue, entry = self.select_queue(number)
+            if queue is None:
+                return None
+            item = queue.pop()
+            self.unbucket_item(item)
+            self.in_flight[number] = [(item, entry[1])]
+            return item
+
+    def claim_same_media(self, number, item, amount):
+        # other waiting requests for the same media, delivered with the upload of the claimed item
+        claimed = []
+        with self.lock:
+            if number not in self.in_flight or item.get("media_key") is None:
+                return claimed
+            for other in list(self.media_items.get(item["media_key"], {}).values())[:amount]:
+                sequence = self.shared.get_sequence(other["queue_id"])
+                if sequence is None:
+                    continue
+                self.shared.remove(other["queue_id"])
+                self.unbucket_item(other)
+                self.in_flight[number].append((other, sequence))
+                claimed.append(other)
+        return claimed
+
+    def complete(self, number, item = None):
+        # completes one item of the uploader, or everything it has in flight
+        with self.lock:
+            if number not in self.in_flight:
+                return None
+            flight = self.in_flight[number]
+            done = [f for f in flight if item is None or f[0] is item]
+            for f in done:
+                flight.remove(f)
+                self.unindex_item(f[0])
+            if len(flight) == 0:
+                del self.in_flight[number]
+            return item
+
+    def release(self, number):
+        # upload could not be done now (e.g. rate limited), put it back for another session
+        with self.lock:
+            if number not in self.in_flight:
+                return None
+            for item, sequence in self.in_flight.pop(number):
+                self.get_queue(item).push(item, sequence)
+                self.bucket_item(item)
+            return True
+
+    def remove(self, item):
+        with self.lock:
+            if self.held.pop(item["queue_id"], None) is not None:
+                self.unindex_item(item)
+                return True
+            if self.get_queue(item).remove(item["queue_id"]) is None:
+                return False
+            self.unindex_item(item)
+            return True
+
+    def remove_user(self, username):
+        total = 0
+        with self.lock:
+            for item in list(self.user_items.get(username, {}).values()):
+                if self.remove(item):
+                    total += 1
+        return total
+
+    def reprioritize_user(self, username, priority):
+        total = 0
+        with self.lock:
+            for item in list(self.user_items.get(username, {}).values()):
+                if item["queue_id"] in self.held:
+                    item["priority"] = priority
+                if item["queue_id"] in self.held or self.get_queue(item).reprioritize(item["queue_id"], priority):
+                    total += 1
+                    if self.journal is not None:
+                        self.journal.record_priority(item["queue_id"], priority)
+        return total
+
+    def upcoming(self, amount):
+        # next `amount` waiting items over all queues, roughly in the order they will be claimed
+        with self.lock:
+            entries = []
+            for queue in [self.shared] + list(self.pinned.values()):
+                entries += queue.smallest(amount)
+            entries.sort(key = lambda e: (e[0], e[1]))
+            return [e[3] for e in entries[:amount]]
+
+    def in_flight_items(self):
+        with self.lock:
+            return [f[0] for flight in self.in_flight.values() for f in flight]
+
+    def top_users(self, amount):
+        with self.lock:
+            return heapq.nlargest(amount, self.user_count.items(), key = lambda x: x[1])
+
+    def contains(self, itemid):
+        with self.lock:
+            return itemid in self.item_index
+
+    def contains_post(self, media_id, username):
+        with self.lock:
+            return (username, media_id) in self.post_index
+
+    def pinned_load(self, number):
+        with self.lock:
+            return len(self.pinned.get(number, ())) + len(self.in_flight.get(number, ()))
+
+    def held_items(self):
+        with self.lock:
+            return [h[0] for h in sorted(self.held.values(), key = lambda h: h[1])]
+
+    def queued_items(self):
+        with self.lock:
+            items = self.shared.to_list()
+            for queue in self.pinned.values():
+                items += queue.to_list()
+            return items
+
+    def to_list(self):
+        # in flight items are saved too, they are only removed once the upload is complete
+        with self.lock:
+            return self.in_flight_items() + self.held_items() + self.queued_items()
+
+    def set_journal(self, journal):
+        with self.lock:
+            self.journal = journal
+
+    def save(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.flush(self.to_list)
+
+    def count_text(self):
+        with self.lock:
+            counts = [str(len(self.shared))] + ["{n}:{c}".format(n = n, c = len(q)) for n, q in sorted(self.pinned.items())]
+            if len(self.held) > 0:
+                counts.append("held:{0}".format(len(self.held)))
+            return " ".join(counts)
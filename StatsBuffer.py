@@ -0,0 +1,104 @@
+import logging
+import datetime
+import threading
+
+# Write-behind buffer for the download statistics
+# the uploader threads only add to in-memory counters, a worker writes them with bulk_write
+# when max_pending downloads are waiting or every interval seconds
+# stop() flushes whatever is left, so a clean stop loses nothing
+# a failed write is merged back and retried with the next flush (at least once, a write that
+# failed halfway can count twice)
+
+class StatsBuffer(object):
+    def __init__(self, storage, max_pending = 100, interval = 10):
+        self.storage = storage
+        self.max_pending = max_pending
+        self.interval = interval
+        self.lock = threading.Lock()
+        # only one flush writes at a time, the worker and stop() may race
+        self.flush_lock = threading.Lock()
+        # downloads[(userid, username)][downloaded_from] = count
+        self.downloads = {}
+        # days[date] = count
+        self.days = {}
+        self.pending = 0
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.full = threading.Event()
+        self.stopping = threading.Event()
+        self.worker = threading.Thread(target = self.flush_worker_func, daemon = True)
+
+    def start(self):
+        self.worker.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.full.set()
+        if self.worker.is_alive():
+            self.worker.join()
+        self.flush()
+
+    def add_download(self, userid, username, downloaded_from):
+        date = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        with self.lock:
+            counts = self.downloads.setdefault((userid, username), {})
+            counts[downloaded_from] = counts.get(downloaded_from, 0) + 1
+            self.days[date] = self.days.get(date, 0) + 1
+            self.pending += 1
+            if self.pending >= self.max_pending:
+                self.full.set()
+
+    def take(self):
+        with self.lock:
+            taken = (self.downloads, self.days, self.pending)
+            self.downloads = {}
+            self.days = {}
+            self.pending = 0
+            return taken
+
+    def merge(self, downloads = None, days = None, pending = 0):
+        with self.lock:
+            for key, counts in (downloads or {}).items():
+                merged = self.downloads.setdefault(key, {})
+                for downloaded_from, amount in counts.items():
+                    merged[downloaded_from] = merged.get(downloaded_from, 0) + amount
+            for date, amount in (days or {}).items():
+                self.days[date] = self.days.get(date, 0) + amount
+            self.pending += pending
+
+    def flush(self):
+        with self.flush_lock:
+            downloads, days, pending = self.take()
+            if len(downloads) == 0 and len(days) == 0:
+                return
+            self.flushes += 1
+
+            # users and days are written separately, so a failure only retries its own part
+            if len(downloads) > 0:
+                try:
+                    self.storage.write_user_downloads(downloads)
+                    self.written += pending
+                except Exception as e:
+                    logging.error("Writing download stats failed: {e}".format(e = str(e)))
+                    self.failures += 1
+                    self.merge(downloads = downloads, pending = pending)
+
+            if len(days) > 0:
+                try:
+                    self.storage.write_day_downloads(days)
+                except Exception as e:
+                    logging.error("Writing day stats failed: {e}".format(e = str(e)))
+                    self.failures += 1
+                    self.merge(days = days)
+
+    def flush_worker_func(self):
+        while not self.stopping.is_set():
+            self.full.wait(self.interval)
+            self.full.clear()
+            self.flush()
+
+    def get_stats_text(self):
+        with self.lock:
+            return "Stats buffer: {p} pending, {w} written in {f} flushes, {e} failed".format(
+                p = self.pending, w = self.written, f = self.flushes, e = self.failures)
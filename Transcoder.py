@@ -0,0 +1,148 @@
+import os
+import re
+import time
+import logging
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import imageio_ffmpeg
+
+from MediaStream import MediaStream
+from MediaCache import MediaCache
+
+# Cuts videos of 60 seconds or more down to 59 seconds in a process pool, off the uploader threads
+# the cut starts at 0 (a keyframe), so a stream copy is valid and only takes a remux
+# re-encoding is only the fallback, when the copy fails or its duration still ends up too long
+# items wait in the scheduler (held) until their cut version is in the media cache
+
+DURATION = 59
+LIMIT = 60
+
+def probe_duration(path):
+    # ffmpeg prints the container duration on stderr, "Duration: 00:00:59.02"
+    result = subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-i", path], capture_output=True)
+    match = re.search(rb"Duration: (\d+):(\d+):(\d+\.\d+)", result.stderr)
+    if match is None:
+        return None
+    return int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+
+def cut_video(source, target, duration = DURATION):
+    # returns the method used, "copy" or "encode"
+    ffmpeg = imageio_ffmpeg.get_ffmpeg_exe()
+    copy = [ffmpeg, "-y", "-v", "error", "-i", source, "-t", str(duration),
+            "-map", "0:v:0", "-map", "0:a:0?", "-c", "copy",
+            "-avoid_negative_ts", "make_zero", "-movflags", "+faststart", target]
+    if subprocess.run(copy, capture_output=True).returncode == 0 and os.path.getsize(target) > 0:
+        length = probe_duration(target)
+        if length is not None and length < LIMIT:
+            return "copy"
+
+    encode = [ffmpeg, "-y", "-v", "error", "-i", source, "-t", str(duration),
+              "-map", "0:v:0", "-map", "0:a:0?", "-c:v", "libx264", "-preset", "veryfast", "-crf", "23",
+              "-c:a", "aac", "-movflags", "+faststart", target]
+    result = subprocess.run(encode, capture_output=True)
+    if result.returncode != 0:
+        raise Exception("ffmpeg failed: {0}".format(result.stderr.decode("utf-8", "replace").strip()[-200:]))
+    return "encode"
+
+def transcode_job(url, source, download_path, target):
+    # runs in a worker process, downloads the original when it is not cached yet
+    start = time.time()
+    if source is None:
+        source = MediaStream(url).save(download_path)
+    method = cut_video(source, target)
+    return method, time.time() - start
+
+class Transcoder(object):
+    def __init__(self, scheduler, cache, workers = 2):
+        self.scheduler = scheduler
+        self.cache = cache
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+        # pending[media_key] = [items], one job per media however many requests wait for it
+        self.pending = {}
+        # jobs not finished yet, cancelled on stop
+        self.futures = set()
+        self.copies = 0
+        self.encodes = 0
+        self.failures = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def start(self):
+        self.pool = ProcessPoolExecutor(max_workers = self.workers)
+
+    def stop(self):
+        if self.pool is None:
+            return
+        # shutdown(cancel_futures=True) needs python 3.9, the queued jobs are cancelled here instead
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            future.cancel()
+        self.pool.shutdown(wait = False)
+
+    def submit(self, item):
+        # item must already be held in the scheduler
+        key = item["media_key"]
+        with self.lock:
+            if key in self.pending:
+                self.pending[key].append(item)
+                return
+            if self.cache.contains(key):
+                self.scheduler.ready(item)
+                return
+            self.pending[key] = [item]
+
+        raw_key = MediaCache.get_key(item)
+        source = self.cache.acquire(raw_key)
+        download_path = self.cache.temp_path(raw_key, 2) if source is None else None
+        target = self.cache.temp_path(key, 2)
+        future = self.pool.submit(transcode_job, item["url"], source, download_path, target)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(lambda f: self.done(f, item, key, raw_key, source, download_path, target))
+
+    def done(self, future, item, key, raw_key, source, download_path, target):
+        with self.lock:
+            self.futures.discard(future)
+        raw_acquired = source is not None
+        try:
+            method, seconds = future.result()
+            if source is None:
+                self.cache.commit(raw_key, 2, download_path)
+                raw_acquired = True
+            self.cache.commit(key, 2, target)
+            self.cache.release(key)
+            with self.lock:
+                if method == "copy":
+                    self.copies += 1
+                else:
+                    self.encodes += 1
+                self.total_time += seconds
+                self.max_time = max(self.max_time, seconds)
+            logging.info("Cut video of @{u} ({m}) in {s:.1f}s".format(u = item["username"], m = method, s = seconds))
+        except Exception as e:
+            # items still go out, the uploader tries the cut itself
+            with self.lock:
+                self.failures += 1
+            logging.error("Cut of @{u} failed: {e}".format(u = item["username"], e = str(e)))
+        finally:
+            if raw_acquired:
+                self.cache.release(raw_key)
+            for path in (download_path, target):
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+            with self.lock:
+                items = self.pending.pop(key, [])
+            for waiting in items:
+                self.scheduler.ready(waiting)
+
+    def get_stats_text(self):
+        with self.lock:
+            done = self.copies + self.encodes
+            average = self.total_time / done if done > 0 else 0
+            return "Transcoder: {d} cut ({c} copy / {e} re-encode, {f} failed), avg {a:.1f}s, max {m:.1f}s, {p} pending".format(
+                d = done, c = self.copies, e = self.encodes, f = self.failures, a = average, m = self.max_time, p = len(self.pending))
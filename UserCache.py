@@ -0,0 +1,79 @@
+import time
+import threading
+from collections import OrderedDict
+
+# Identity map of user documents for Storage, found by userid or username
+# Storage writes every change through (the document returned by the update replaces the cached one),
+# entries expire after ttl seconds so edits from outside the bot show up, least recently used entries
+# are dropped above size
+# callers get copies, a changed dict never leaks into the cache
+
+class UserCache(object):
+    def __init__(self, ttl = 300, size = 5000):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        # entries[_id] = (user, expires), least recently used first
+        self.entries = OrderedDict()
+        self.by_userid = {}
+        self.by_username = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, userid = None, username = None):
+        with self.lock:
+            key = None
+            if userid is not None and userid in self.by_userid:
+                key = self.by_userid[userid]
+            elif username is not None and username in self.by_username:
+                key = self.by_username[username]
+
+            if key is None:
+                self.misses += 1
+                return None
+            user, expires = self.entries[key]
+            if expires < time.time():
+                self.drop(key)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return dict(user)
+
+    def put(self, user):
+        if user is None:
+            return
+        with self.lock:
+            key = user["_id"]
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = (dict(user), time.time() + self.ttl)
+            if user.get("userid"):
+                self.by_userid[user["userid"]] = key
+            if user.get("username"):
+                self.by_username[user["username"]] = key
+            while len(self.entries) > self.size:
+                self.drop(next(iter(self.entries)))
+
+    def drop(self, key):
+        # lock must be held
+        user, _ = self.entries.pop(key)
+        if self.by_userid.get(user.get("userid")) == key:
+            del self.by_userid[user["userid"]]
+        if self.by_username.get(user.get("username")) == key:
+            del self.by_username[user["username"]]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_userid.clear()
+            self.by_username.clear()
+
+    def get_stats_text(self):
+        with self.lock:
+            total = self.hits + self.misses
+            rate = 100.0 * self.hits / total if total > 0 else 0.0
+            return "User cache: {n} users, {r:.1f}% hits ({h}/{t}), {e} expired".format(
+                n = len(self.entries), r = rate, h = self.hits, t = total, e = self.expired)
@@ -1,8 +1,7 @@
 
 class dVideo(object):
-    def __init__(self, header, upload_id, recipient):
+    def __init__(self, upload_id, recipient):
         self.username = None
         self.download_from = None
-        self.header = header
         self.upload_id = upload_id
         self.recipient = recipient
\ No newline at end of file